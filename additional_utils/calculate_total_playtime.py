@@ -1,42 +1,133 @@
+import argparse
+import json
 import os
 import pandas as pd
-import pickle
+import sys
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ingest import PLAY_ACTIVITY_COLUMNS, read_chunks
+from storage import DATABASE, connect, read_crossreference_chunks
 
-def read_data(filename: str) -> pd.DataFrame:
+# Columns needed from the Apple Music Play Activity file, the offset to UTC is used for the local time if the file contains it
+PLAYTIME_COLUMNS = {
+    'Event Start Timestamp': str,
+    'Song Name': PLAY_ACTIVITY_COLUMNS['Song Name'],
+    'Play Duration Milliseconds': PLAY_ACTIVITY_COLUMNS['Play Duration Milliseconds'],
+    'UTC Offset In Seconds': PLAY_ACTIVITY_COLUMNS['UTC Offset In Seconds'],
+}
+REPORTS = ['year', 'month', 'hour', 'track']
+
+
+class PlaytimeStatistics:
+    """
+    Running totals of the playtime, streams and skips per year, month, hour of day and track, which are updated one chunk of streams at a time.
+    Streams without a play duration, longer than 5 hours or from before 2015 are ignored and streams of at most 25 seconds count as skipped.
+    """
+    def __init__(self):
+        self.totals = {report: pd.DataFrame(columns=['Milliseconds', 'Streams', 'Skips'], dtype='int64') for report in REPORTS}
+        self.streams = 0
+        self.unmatched = 0
+        self.identified = False
+
+    def update(self, df: pd.DataFrame):
+        """
+        Add the streams of the chunk to the totals.
+        """
+        # Parse the timestamps only once and shift them to the local time if the offset to UTC is known
+        timestamps = df['Event Start Timestamp']
+        if not pd.api.types.is_datetime64_dtype(timestamps):
+            timestamps = pd.to_datetime(timestamps, format='ISO8601', utc=True).dt.tz_convert(None)
+        if 'UTC Offset In Seconds' in df.columns:
+            timestamps = timestamps + pd.to_timedelta(df['UTC Offset In Seconds'].fillna(0).astype('int64'), unit='s')
+
+        # Only keep the streams with a valid play duration since 2015
+        durations = df['Play Duration Milliseconds']
+        valid = (timestamps.notna() & durations.between(0, 5*60*60*1000) & (timestamps.dt.year >= 2015)).fillna(False).to_numpy(dtype=bool)
+        timestamps, durations = timestamps[valid], durations[valid].astype('int64')
+        streams = pd.DataFrame({'Milliseconds': durations, 'Streams': 1, 'Skips': (durations <= 25000).astype('int64')})
+
+        # Add the totals of every report, the chunk is only grouped once per report
+        keys = {'year': timestamps.dt.year, 'month': timestamps.dt.to_period('M'), 'hour': timestamps.dt.hour, 'track': df['Song Name'][valid]}
+        for report, key in keys.items():
+            self.totals[report] = self.totals[report].add(streams.groupby(key, observed=True).sum(), fill_value=0).astype('int64')
+
+        # Count the streams without a track identifier if the streams have been crossreferenced
+        self.streams += len(streams)
+        if 'Track Identifier' in df.columns:
+            self.identified = True
+            self.unmatched += int(df['Track Identifier'][valid].isna().sum())
+
+    def reports(self) -> dict:
+        """
+        Return the reports as DataFrames with the playtime in minutes and the skip ratio, along with a summary of all streams.
+        """
+        reports = {}
+        for report, totals in self.totals.items():
+            totals = totals.sort_values('Milliseconds', ascending=False) if report == 'track' else totals.sort_index()
+            reports[report] = pd.DataFrame({
+                'Minutes': (totals['Milliseconds'] / 60000).round(2),
+                'Streams': totals['Streams'],
+                'Skip Ratio': (totals['Skips'] / totals['Streams']).round(4),
+            }).rename_axis(report.capitalize())
+
+        totals = self.totals['year'].sum()
+        reports['summary'] = {
+            'Minutes': round(totals['Milliseconds'] / 60000, 2),
+            'Streams': int(totals['Streams']),
+            'Skip Ratio': round(totals['Skips'] / totals['Streams'], 4) if totals['Streams'] else None,
+            'Unmatched Share': round(self.unmatched / self.streams, 4) if self.identified and self.streams else None,
+        }
+        return reports
+
+
+def calculate_playtime(chunks) -> dict:
     """
-    Read the data from the csv file and return it as a DataFrame.
+    Calculate the reports in a single pass over the chunks of streams.
     """
-    # Strip file extension
-    pickle_filename = os.path.splitext(filename)[0] + '.pkl'
-    # Check if pickle file exists
-    if os.path.exists(pickle_filename):
-        with open(pickle_filename, 'rb') as f:
-            return pickle.load(f)
+    statistics = PlaytimeStatistics()
+    for df in chunks:
+        statistics.update(df)
+    return statistics.reports()
 
-    try:
-        df = pd.read_csv(filename, on_bad_lines='error', encoding='utf-8', engine='python')
-    except pd.errors.EmptyDataError:
-        df = pd.DataFrame()
-    except (TypeError, ValueError):
-        df = pd.read_csv(filename, sep=';', on_bad_lines='warn', encoding='utf-8', engine='python')
-        
-    # Save DataFrame to pickle file
-    with open(pickle_filename, 'wb') as f:
-        pickle.dump(df, f)    
-        
-    return df
 
+def print_reports(reports: dict, top_tracks: int = 25):
+    """
+    Print the reports as tables, only including the most played tracks.
+    """
+    for report in REPORTS:
+        print(reports[report].head(top_tracks) if report == 'track' else reports[report].to_string())
+        print()
+    for name, value in reports['summary'].items():
+        print(f'{name}: {value}')
 
-def calculate_playtime(df: pd.DataFrame):
+
+def export_reports(reports: dict, export_path: str):
     """
-    Calculate the total playtime in minutes for each year and all years combined.
+    Export the reports to a json file.
     """
-    df = df[['Event Start Timestamp', 'Play Duration Milliseconds']].dropna()
-    df = df[(df['Play Duration Milliseconds'].between(0, 5*60*60*1000)) & (pd.to_datetime(df['Event Start Timestamp'], format='ISO8601').dt.year >= 2015)]
-    print((df.groupby(pd.to_datetime(df['Event Start Timestamp'], format='ISO8601').dt.year)['Play Duration Milliseconds'].sum() / 60000).round(2))
-    print(f'Total Play Duration in Minutes: {(df["Play Duration Milliseconds"].sum() / 1000 / 60).round(2)}')
+    with open(export_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            **{report: reports[report].reset_index().astype({report.capitalize(): str}).to_dict('records') for report in REPORTS},
+            'summary': reports['summary'],
+        }, f, ensure_ascii=False, indent=2)
 
 
 if __name__ == '__main__':
-    calculate_playtime(read_data(r'<your_play_acitivity_path>'))
+    parser = argparse.ArgumentParser(description='Calculate the playtime per year, month, hour of day and track.')
+    parser.add_argument('play_activity', nargs='?', help='path of the Apple Music Play Activity file')
+    parser.add_argument('--crossreferenced', action='store_true', help='use the crossreferenced streams of the database instead, which also reports the share of unmatched streams')
+    parser.add_argument('--database', default=DATABASE, help='sqlite3 database of the crossreferenced streams')
+    parser.add_argument('--top-tracks', type=int, default=25, help='number of the most played tracks to print')
+    parser.add_argument('--export', default=None, help='json file the reports are exported to')
+    args = parser.parse_args()
+    if args.crossreferenced == bool(args.play_activity):
+        parser.error('either give the path of the Play Activity file or use --crossreferenced')
+
+    if args.crossreferenced:
+        with connect(args.database) as conn:
+            reports = calculate_playtime(read_crossreference_chunks(conn))
+    else:
+        reports = calculate_playtime(read_chunks(args.play_activity, columns=PLAYTIME_COLUMNS))
+    print_reports(reports, top_tracks=args.top_tracks)
+    if args.export:
+        export_reports(reports=reports, export_path=args.export)
@@ -1,122 +1,56 @@
 import os
 import pandas as pd
-import pickle
 import sqlite3
+import sys
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from crossreference import find_closest_matches, prepare_daily_tracks, prepare_play_activity, rematch_based_on_length
+from ingest import DAILY_TRACKS_COLUMNS, PLAY_ACTIVITY_COLUMNS, read_data
+from storage import compact_streams, connect, read_crossreference, read_first_identified, read_watermark, update_matches, write_crossreference, write_watermark
 
-def read_data(filename: str) -> pd.DataFrame:
-    """
-    Read the data from the csv file and return it as a DataFrame.
-    """
-    # Strip file extension
-    pickle_filename = os.path.splitext(filename)[0] + '.pkl'
-    # Check if pickle file exists
-    if os.path.exists(pickle_filename):
-        with open(pickle_filename, 'rb') as f:
-            return pickle.load(f)
-
-    try:
-        df = pd.read_csv(filename, on_bad_lines='error', encoding='utf-8', engine='python')
-    except pd.errors.EmptyDataError:
-        df = pd.DataFrame()
-    except (TypeError, ValueError):
-        df = pd.read_csv(filename, sep=';', on_bad_lines='warn', encoding='utf-8', engine='python')
-        
-    # Save DataFrame to pickle file
-    with open(pickle_filename, 'wb') as f:
-        pickle.dump(df, f)    
-        
-    return df
-
-def append_new_data(df1: pd.DataFrame, df2: pd.DataFrame) -> pd.DataFrame:
-    """
-    Delete all entries in df1 from September 2023 onwards and append all entries from df2 from September 2023 onwards.
-    """
-    # Convert 'Event Start Timestamp' in both DataFrames to datetime and make sure it is timezone-naive
-    df1['Event Start Timestamp'] = pd.to_datetime(df1['Event Start Timestamp'], format='ISO8601').dt.tz_localize(None)
-    df2['Event Start Timestamp'] = pd.to_datetime(df2['Event Start Timestamp'], format='ISO8601').dt.tz_localize(None)
-
-    # Delete all entries in df1 bigger than September 2023
-    df1 = df1[df1['Event Start Timestamp'] < pd.to_datetime('2023-09-01')]
-
-    # Delete all entries in df2 smaller than September 2023
-    df2 = df2[df2['Event Start Timestamp'] > pd.to_datetime('2023-09-01')]
-    df2.dropna(subset=['Event Start Timestamp'])
-    df2 = df2.loc[:, ['Event Start Timestamp', 'Song Name', 'Play Duration Milliseconds', 'Media Duration In Milliseconds']]
-    df2.replace(0, pd.NA, inplace=True)
-    df2.dropna(inplace=True)
-
-    return df1._append(df2, ignore_index=True)
 
 def crossreference(df1: pd.DataFrame, df2: pd.DataFrame) -> pd.DataFrame:
     """
     Crossreference the two DataFrames by matching the song name and the event timestamp.
     """
-    # Convert date and hours in df2 to datetime
-    df2['Date Played'] = pd.to_datetime(df2['Date Played'], format='%Y%m%d')
-    df2 = df2.assign(Hours=df2['Hours'].str.split(',')).explode('Hours')
-    df2['Hours'] = df2['Hours'].astype(int)
-
-    # Create a datetime column and make sure it is timezone-naive
-    df2['Event Timestamp'] = pd.to_datetime(df2['Date Played']) + pd.to_timedelta(df2['Hours'], unit='h')
+    # Match all songs in df1 without a track identifier to their closest track in df2
+    return find_closest_matches(df1, prepare_daily_tracks(df2))
 
-    df2.dropna(subset=['Event Timestamp', 'Track Description'], inplace=True)
-    df2 = df2.loc[:, ['Event Timestamp', 'Track Description', 'Track Identifier']]
 
-    def find_closest_match(row: pd.Series, df: pd.DataFrame) -> pd.Series:
-        if pd.isna(row['Track Identifier']):
-            # Create a mask to filter df based on the condition
-            mask = (
-                df['Event Timestamp'].between(row['Event Start Timestamp'] - pd.Timedelta(hours=2), row['Event Start Timestamp'] + pd.Timedelta(hours=2)) &
-                df['Track Description'].str.contains(row['Song Name'], case=False, regex=False, na=False)
-            )
-            # Apply the mask to df
-            matches = df[mask]
-
-            # If there are any matches
-            if not matches.empty:
-                # Find the closest match based on the 'Event Timestamp'
-                closest_match = matches[abs(matches['Event Timestamp'] - row['Event Start Timestamp']) == abs(matches['Event Timestamp'] - row['Event Start Timestamp']).min()].iloc[0]
-                # Update the row with the details of the closest match
-                row['Song Name'] = closest_match['Track Description']
-                row['Track Identifier'] = closest_match['Track Identifier']
-                print(f'Matched {row["Song Name"]} ({row["Event Start Timestamp"]}) based on time')
+def update_crossreference(conn: sqlite3.Connection, play_activity: pd.DataFrame, daily_tracks: pd.DataFrame, tolerance: int = 0):
+    """
+    Crossreference the streams after the watermark together with the still unmatched streams, then upsert them into the 'crossreference' table.
+    """
+    watermark = read_watermark(conn)
 
-        return row
+    # Only the streams after the watermark are new, everything before has already been crossreferenced
+    new_songs = prepare_play_activity(play_activity)
+    new_songs = new_songs[new_songs['Event Start Timestamp'] > watermark]
+    print(f'Number of new songs: {len(new_songs)} after {watermark}')
 
-    # Apply the find_closest_match function to the df1 DataFrame
-    return df1.apply(find_closest_match, axis=1, df=df2)
+    # Retry the streams which are still unmatched
+    unmatched_songs = read_crossreference(conn, identified=False, rowid=True)
+    pending_songs = pd.concat([unmatched_songs, new_songs], ignore_index=True)
+    pending_songs = compact_streams(pending_songs)
+    pending_songs = crossreference(pending_songs, daily_tracks)
 
-def rematch_based_on_length(row: pd.Series, df: pd.DataFrame) -> pd.Series:
-    """
-    Rematch songs based on the song name and the media duration in milliseconds.
-    """
-    # If the 'Track Identifier' is NaN
-    if pd.isna(row['Track Identifier']):
-        # Find matches based on 'Song Name' and 'Media Duration In Milliseconds'
-        matches = df[(df['Song Name'].str.contains(row['Song Name'], regex=False, case=False)) & (df['Media Duration In Milliseconds'] == row['Media Duration In Milliseconds']) & (~pd.isna(df['Track Identifier']))]
-        # If there are any matches
-        if not matches.empty:
-            # Update the row with the details of the first match
-            row['Track Identifier'] = matches.iloc[0]['Track Identifier']
-            row['Song Name'] = matches.iloc[0]['Song Name']
-            print(f'Rematched {row["Song Name"]} ({row["Event Start Timestamp"]}) based on length')
+    # Rematch based on length against the first identified stream of every song name and media duration
+    identified_songs = read_first_identified(conn)
+    songs = rematch_based_on_length(pd.concat([identified_songs, pending_songs], ignore_index=True), tolerance=tolerance).iloc[len(identified_songs):]
+    print(f'Number of matches: {songs["Track Identifier"].notna().sum()}, Number of unmatched songs: {songs["Track Identifier"].isna().sum()}')
 
-    return row
+    # Update the previously unmatched streams and insert the new ones
+    updated_count = update_matches(conn, songs[songs['rowid'].notna()])
+    inserted_songs = songs[songs['rowid'].isna()].sort_values(by='Event Start Timestamp')
+    write_crossreference(conn, inserted_songs)
+    if not inserted_songs.empty:
+        write_watermark(conn, inserted_songs['Event Start Timestamp'].max())
+    print(f'Updated {updated_count} and inserted {len(inserted_songs)} songs.')
 
 
 if __name__ == '__main__':
-    matched_songs = pd.read_sql('SELECT * FROM crossreference', sqlite3.connect('identified_songs.sqlite3'))
-    new_play_activity_path = read_data(r'<your_new_play_activity_path>')
-    new_play_history_daily_path = read_data(r'<your_new_play_history_daily_path>')
-
-    print(f'Number of matches: {matched_songs["Track Identifier"].notna().sum()}, Number of unmatched songs: {matched_songs["Track Identifier"].isna().sum()}')
-    matched_songs = append_new_data(matched_songs, new_play_activity_path)
-    print(f'Number of matches: {matched_songs["Track Identifier"].notna().sum()}, Number of unmatched songs: {matched_songs["Track Identifier"].isna().sum()}')
-    matched_songs = crossreference(matched_songs, new_play_history_daily_path)
-    print(f'Number of matches: {matched_songs["Track Identifier"].notna().sum()}, Number of unmatched songs: {matched_songs["Track Identifier"].isna().sum()}')
-    matched_songs = matched_songs.apply(rematch_based_on_length, axis=1, df=matched_songs)
-    print(f'Number of matches: {matched_songs["Track Identifier"].notna().sum()}, Number of unmatched songs: {matched_songs["Track Identifier"].isna().sum()}')
+    new_play_activity_path = read_data(r'<your_new_play_activity_path>', columns=PLAY_ACTIVITY_COLUMNS)
+    new_play_history_daily_path = read_data(r'<your_new_play_history_daily_path>', columns=DAILY_TRACKS_COLUMNS)
 
-    # Save the 'matched_songs' DataFrame to a sqlite3 database sorted by 'Event Start Timestamp'
-    matched_songs.sort_values(by='Event Start Timestamp').to_sql('crossreference', sqlite3.connect('identified_songs.sqlite3'), if_exists='replace', index=False)
+    with connect() as conn:
+        update_crossreference(conn, new_play_activity_path, new_play_history_daily_path)
@@ -0,0 +1,95 @@
+import argparse
+import networkx as nx
+import numpy as np
+import os
+import pandas as pd
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from calculate_optimal_path import graph_data, walk_path
+from metrics import COUNTERS
+
+
+def listening_history(songs: int, streams: int, seed: int) -> pd.DataFrame:
+    """
+    Generate a sequence of streams where the next song often follows the current one on its album and is drawn by its popularity otherwise,
+    which gives transition graphs with a similar share of dead ends as real listening histories.
+    """
+    rng = np.random.default_rng(seed)
+    popularity = 1 / np.arange(1, songs + 1) ** 1.1
+    picks = rng.choice(songs, size=streams, p=popularity / popularity.sum())
+    follow = rng.random(streams) < 0.3
+    sequence = picks.copy()
+    for i in np.flatnonzero(follow[1:]) + 1:
+        sequence[i] = (sequence[i - 1] + 1) % songs
+    return pd.DataFrame({'Song Name': [f'Song {song}' for song in sequence]})
+
+
+def walk_path_all_pairs(G: nx.Graph, start_node: str) -> tuple:
+    """
+    Walk the graph like walk_path, but find the jump targets with all_pairs_shortest_path_length like before the bounded breadth-first search.
+    Only works on connected graphs, as the unreachable nodes are missing from the shortest paths.
+    """
+    path = [start_node]
+    visited = set(path)
+    median_weight = np.median(list(nx.get_edge_attributes(G, 'weight').values()))
+    shortest_paths = dict(nx.all_pairs_shortest_path_length(G))
+
+    current_node = start_node
+    total_weight, total_jumps = 0, 0
+    while len(visited) < len(G.nodes()):
+        # Find the heaviest unvisited neighbor
+        neighbors = [(neighbor, G[current_node][neighbor]['weight']) for neighbor in G.neighbors(current_node) if neighbor not in visited]
+        if neighbors:
+            next_node, weight = max(neighbors, key=lambda x: x[1])
+            total_weight += weight
+        else:
+            # Find the closest unvisited neighbor with the highest degree
+            neighbors = [(node, shortest_paths[current_node][node]) for node in G.nodes() if node not in visited]
+            next_node, path_length = min(neighbors, key=lambda x: (x[1], -G.degree(x[0], weight='weight')))
+            total_weight += median_weight * (1 / path_length)
+            total_jumps += 1
+
+        path.append(next_node)
+        visited.add(next_node)
+        current_node = next_node
+
+    return path, total_weight, total_jumps
+
+
+def fastest(function, repeat: int) -> tuple:
+    """
+    Run the function several times and return its result along with the fastest wall time.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the jumps of the walk using all-pairs shortest paths with the bounded breadth-first search.')
+    parser.add_argument('--sizes', default='250,500,1000,2000', help='comma-separated numbers of songs in the library')
+    parser.add_argument('--streams-per-song', type=int, default=10, help='number of streams per song of the library')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs per size, the fastest run is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(f'{"Songs":>8}{"Edges":>10}{"Jumps":>8}{"All pairs":>12}{"BFS":>10}{"BFS jumps":>12}{"Speedup":>10}{"Same path":>11}')
+    for songs in (int(size) for size in args.sizes.split(',')):
+        random.seed(args.seed)
+        G = graph_data(listening_history(songs, songs * args.streams_per_song, args.seed))
+        # The previous implementation needs a connected graph
+        G = G.subgraph(max(nx.connected_components(G), key=len)).copy()
+        start_node = random.Random(args.seed).choice(list(G.nodes()))
+
+        old, old_seconds = fastest(lambda: walk_path_all_pairs(G, start_node), args.repeat)
+        COUNTERS.clear()
+        new, new_seconds = fastest(lambda: walk_path(G, start_node), args.repeat)
+        jump_seconds = COUNTERS.get('shortest path seconds', 0) / args.repeat
+        print(f'{len(G):>8}{G.number_of_edges():>10}{new[2]:>8}{old_seconds:>11.3f}s{new_seconds:>9.3f}s{jump_seconds:>11.4f}s'
+              f'{old_seconds / new_seconds:>9.1f}x{str(old[0] == new[0] and old[2] == new[2]):>11}')
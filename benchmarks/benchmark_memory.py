@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import pandas as pd
+import resource
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from calculate_optimal_path import preprocess_data
+from crossreference import find_closest_matches, match_streams, prepare_daily_tracks, rematch_based_on_length, rematch_streams
+from generate_data import generate_data
+from ingest import DAILY_TRACKS_COLUMNS, PLAY_ACTIVITY_COLUMNS, read_data
+
+# Dtypes of the columns before the streams were kept in STREAM_DTYPES, the names were read as objects and stored durations and identifiers read back as int64 and float64
+OLD_PLAY_ACTIVITY_COLUMNS = dict(PLAY_ACTIVITY_COLUMNS, **{'Song Name': str, 'Play Duration Milliseconds': 'Int64', 'Media Duration In Milliseconds': 'Int64'})
+OLD_DAILY_TRACKS_COLUMNS = dict(DAILY_TRACKS_COLUMNS, **{'Track Description': str})
+OLD_STREAM_DTYPES = {'Song Name': object, 'Play Duration Milliseconds': 'int64', 'Media Duration In Milliseconds': 'int64', 'Track Identifier': 'float64'}
+
+
+def prepare_play_activity_old(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Select the necessary columns of the Play Activity DataFrame like prepare_play_activity, but infer the dtypes instead of compacting them.
+    """
+    if 'UTC Offset In Seconds' in df.columns:
+        timestamps = pd.to_datetime(df['Event Start Timestamp'], format='ISO8601', utc=True).dt.tz_convert(None)
+        df['Event Start Timestamp'] = timestamps + pd.to_timedelta(df['UTC Offset In Seconds'].fillna(0).astype('int64'), unit='s')
+    else:
+        df['Event Start Timestamp'] = pd.to_datetime(df['Event Start Timestamp'].str.replace(r'(?<=\d)(Z|[+-]\d{2}:?\d{2})$', '', regex=True), format='ISO8601')
+    df = df.dropna(subset=['Event Start Timestamp'])
+    df = df.loc[:, ['Event Start Timestamp', 'Song Name', 'Play Duration Milliseconds', 'Media Duration In Milliseconds']]
+    df.replace(0, pd.NA, inplace=True)
+    return df.dropna().infer_objects()
+
+
+def preprocess_data_old(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Preprocess the data like preprocess_data before the compact dtypes, with temporary columns and groupby transforms.
+    """
+    print(f'Number of songs: {len(df)}, unique: {len(df["Track Identifier"].unique())}, starting preprocessing...')
+
+    # Add the streams that belong to the same song session together
+    df['Time Difference Milliseconds'] = df['Event Start Timestamp'].diff().dt.total_seconds() * 1000
+    df['Is Same Song Session'] = df['Track Identifier'].eq(df['Track Identifier'].shift()) & (df['Time Difference Milliseconds'] <= 180000)
+    df['Play Duration Milliseconds'] = df.groupby((~df['Is Same Song Session']).cumsum())['Play Duration Milliseconds'].transform('sum')
+    df = df[~df['Is Same Song Session']].drop(columns=['Time Difference Milliseconds', 'Is Same Song Session'])
+
+    # Remove streams which are too short, have no track identifier, have been played for less than 5 minutes in total or only once in total
+    df = df[
+        (df['Play Duration Milliseconds'] > 25000) &
+        (df['Track Identifier'].notna()) &
+        (df.groupby('Song Name')['Play Duration Milliseconds'].transform('sum') > 300000) &
+        (df.groupby('Song Name')['Song Name'].transform('count') > 1)
+    ]
+
+    print(f'Number of songs: {len(df)}, unique: {len(df["Track Identifier"].unique())}, finished preprocessing.')
+    return df
+
+
+def traced(function, trace: bool) -> tuple:
+    """
+    Run the function and return its result along with the peak of the memory allocated by Python while it ran, or 0 if it is not traced.
+    """
+    if not trace:
+        return function(), 0
+    tracemalloc.start()
+    try:
+        return function(), tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(play_activity_path: str, daily_tracks_path: str, dtypes: str, trace: bool) -> dict:
+    """
+    Crossreference and preprocess the generated files with the old or the compact dtypes and return the sizes and peaks in bytes.
+    """
+    if dtypes == 'old':
+        play_activity, daily_tracks = read_data(play_activity_path, columns=OLD_PLAY_ACTIVITY_COLUMNS), read_data(daily_tracks_path, columns=OLD_DAILY_TRACKS_COLUMNS)
+        matched, crossreference_peak = traced(lambda: rematch_based_on_length(find_closest_matches(prepare_play_activity_old(play_activity), prepare_daily_tracks(daily_tracks))), trace)
+        # The stored streams were read back with the identifiers as float64
+        matched = matched.sort_values(by='Event Start Timestamp').reset_index(drop=True).astype(OLD_STREAM_DTYPES)
+        preprocessed, preprocess_peak = traced(lambda: preprocess_data_old(matched.copy()), trace)
+    else:
+        play_activity, daily_tracks = read_data(play_activity_path, columns=PLAY_ACTIVITY_COLUMNS), read_data(daily_tracks_path, columns=DAILY_TRACKS_COLUMNS)
+        matched, crossreference_peak = traced(lambda: rematch_streams(match_streams(play_activity, daily_tracks)), trace)
+        matched = matched.reset_index(drop=True)
+        preprocessed, preprocess_peak = traced(lambda: preprocess_data(matched), trace)
+
+    # Compare the results of both dtypes independent of their representation
+    preprocessed = preprocessed[['Event Start Timestamp', 'Song Name', 'Play Duration Milliseconds', 'Track Identifier']].astype(
+        {'Song Name': str, 'Play Duration Milliseconds': 'int64', 'Track Identifier': 'int64'})
+    return {
+        'frame': int(matched.memory_usage(deep=True).sum()),
+        'crossreference': crossreference_peak,
+        'preprocess': preprocess_peak,
+        'max rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'result': int(pd.util.hash_pandas_object(preprocessed, index=False).sum()),
+    }
+
+
+def run(play_activity_path: str, daily_tracks_path: str, dtypes: str, trace: bool) -> dict:
+    """
+    Measure the dtypes in a fresh process, so that the maximum resident set size only covers this run.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+        output = f.name
+    try:
+        subprocess.run([sys.executable, __file__, '--measure', dtypes, '--play-activity', play_activity_path, '--daily-tracks', daily_tracks_path,
+                        '--output', output] + (['--trace'] if trace else []), check=True, stdout=subprocess.DEVNULL)
+        with open(output, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    finally:
+        os.remove(output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the peak memory of the crossreference and the preprocessing with the old dtypes and with STREAM_DTYPES.')
+    parser.add_argument('--sizes', default='20000,200000', help='comma-separated numbers of streams')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--measure', choices=['old', 'compact'], help=argparse.SUPPRESS)
+    parser.add_argument('--play-activity', help=argparse.SUPPRESS)
+    parser.add_argument('--daily-tracks', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    parser.add_argument('--trace', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(measure(args.play_activity, args.daily_tracks, args.measure, args.trace), f)
+        sys.exit()
+
+    # The peaks are traced with tracemalloc, the maximum resident set size is measured in separate runs without its overhead
+    mib = 1024 * 1024
+    print(f'{"Streams":>8}{"Dtypes":>9}{"Frame":>12}{"Crossreference":>16}{"Preprocess":>12}{"Max RSS":>12}{"Same result":>13}')
+    with tempfile.TemporaryDirectory() as directory:
+        for events in (int(size) for size in args.sizes.split(',')):
+            play_activity_path, daily_tracks_path = os.path.join(directory, f'play_activity_{events}.csv'), os.path.join(directory, f'daily_tracks_{events}.csv')
+            generate_data(play_activity_path, daily_tracks_path, events=events, seed=args.seed)
+            results = {dtypes: dict(run(play_activity_path, daily_tracks_path, dtypes, trace=True), **{
+                'max rss': run(play_activity_path, daily_tracks_path, dtypes, trace=False)['max rss']
+            }) for dtypes in ('old', 'compact')}
+            for dtypes, result in results.items():
+                print(f'{events:>8}{dtypes:>9}{result["frame"] / mib:>8.1f} MiB{result["crossreference"] / mib:>12.1f} MiB{result["preprocess"] / mib:>8.1f} MiB'
+                      f'{result["max rss"] / mib:>8.0f} MiB{str(result["result"] == results["old"]["result"]):>13}')
@@ -0,0 +1,77 @@
+import argparse
+import os
+import pandas as pd
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from crossreference import match_streams, rematch_based_on_length
+from generate_data import generate_data
+from ingest import DAILY_TRACKS_COLUMNS, PLAY_ACTIVITY_COLUMNS, read_data
+from text_index import SubstringIndex
+
+
+def rematch_row(row: pd.Series, df: pd.DataFrame, index: SubstringIndex, tolerance: int) -> pd.Series:
+    """
+    Rematch the song to the first identified song whose Song Name contains its name and whose media duration differs by at most the tolerance,
+    like the row-by-row rematch before rematch_based_on_length.
+    """
+    if pd.isna(row['Track Identifier']):
+        matches = df[index.contains(row['Song Name']) &
+                     (abs(df['Media Duration In Milliseconds'] - row['Media Duration In Milliseconds']) <= tolerance) &
+                     (~pd.isna(df['Track Identifier']))]
+        if not matches.empty:
+            row['Track Identifier'] = matches.iloc[0]['Track Identifier']
+            row['Song Name'] = matches.iloc[0]['Song Name']
+    return row
+
+
+def rematch_apply(df: pd.DataFrame, tolerance: int) -> pd.DataFrame:
+    """
+    Rematch all songs without a Track Identifier one row at a time.
+    """
+    return df.apply(rematch_row, axis=1, df=df, index=SubstringIndex(df['Song Name']), tolerance=tolerance)
+
+
+def values(df: pd.DataFrame) -> list:
+    """
+    Return the Song Name and Track Identifier of every song independent of their dtypes, with None for missing values.
+    """
+    return [(name if pd.notna(name) else None, int(identifier) if pd.notna(identifier) else None)
+            for name, identifier in zip(df['Song Name'].astype(object), df['Track Identifier'].astype(object))]
+
+
+def timed(function) -> tuple:
+    """
+    Run the function and return its result along with its wall time.
+    """
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the row-by-row rematch with the duration-bucketed rematch_based_on_length.')
+    parser.add_argument('--sizes', default='1000,6000,20000', help='comma-separated numbers of streams')
+    parser.add_argument('--tolerances', default='0,5', help='comma-separated tolerances of the media duration in milliseconds')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(f'{"Streams":>8}{"Unmatched":>11}{"Tolerance":>11}{"Rematched":>11}{"Apply":>10}{"Bucketed":>10}{"Speedup":>10}{"Same frames":>13}')
+    with tempfile.TemporaryDirectory() as directory:
+        for events in (int(size) for size in args.sizes.split(',')):
+            # Match the generated streams based on time first, the rematch only looks at the songs which are still unmatched afterwards
+            play_activity_path, daily_tracks_path = os.path.join(directory, f'play_activity_{events}.csv'), os.path.join(directory, f'daily_tracks_{events}.csv')
+            generate_data(play_activity_path, daily_tracks_path, events=events, seed=args.seed)
+            matched = match_streams(read_data(play_activity_path, columns=PLAY_ACTIVITY_COLUMNS), read_data(daily_tracks_path, columns=DAILY_TRACKS_COLUMNS))
+            matched = matched.reset_index(drop=True)
+
+            for tolerance in (int(tolerance) for tolerance in args.tolerances.split(',')):
+                old, old_seconds = timed(lambda: rematch_apply(matched.astype({'Song Name': object}), tolerance))
+                new, new_seconds = timed(lambda: rematch_based_on_length(matched, tolerance))
+                same = values(old) == values(new)
+                rematched = new['Track Identifier'].notna().sum() - matched['Track Identifier'].notna().sum()
+                print(f'{len(matched):>8}{matched["Track Identifier"].isna().sum():>11}{tolerance:>11}{rematched:>11}{old_seconds:>9.2f}s{new_seconds:>9.2f}s'
+                      f'{old_seconds / new_seconds:>9.1f}x{str(same):>13}')
+                assert same, f'The rematched frames differ for {events} streams with a tolerance of {tolerance}'
@@ -0,0 +1,175 @@
+import argparse
+import numpy as np
+import os
+import pandas as pd
+
+# Words the song titles are made of, some titles contain others like 'Love' and 'Love Song' to exercise the containment matching
+TITLE_WORDS = [
+    'Love', 'Song', 'Night', 'Blue', 'Sky', 'Dance', 'Dancer', 'Fire', 'Heart', 'Rain', 'Summer', 'Dream', 'Gold', 'Home',
+    'Light', 'River', 'Run', 'Stay', 'Wild', 'Young', 'Ocean', 'Moon', 'Star', 'Road', 'Straße', 'Ø', 'Café', 'Tonight',
+]
+ALBUM_WORDS = ['Greatest', 'Hits', 'Live', 'Sessions', 'Deluxe', 'Remastered', 'Vol.', 'Stories', 'Chapters', 'Echoes']
+
+
+def generate_library(library_size: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Generate a library of songs with their track identifier, song name, artist, media duration and track description like in the Daily Tracks file.
+    Titles repeat across artists and contain each other, as real song names do.
+    """
+    word_counts = rng.choice([1, 1, 2, 2, 2, 3, 4], size=library_size)
+    words = rng.choice(TITLE_WORDS, size=(library_size, 4))
+    titles = [' '.join(row[:length]) for row, length in zip(words, word_counts)]
+    # Most titles are made unique by a number, the others are shared by several songs
+    numbers = rng.integers(1, 1000, size=library_size)
+    titles = [f'{title} {number}' if keep else title for title, number, keep in zip(titles, numbers, rng.random(library_size) < 0.8)]
+    artists = np.array([f'Artist {i}' for i in range(max(library_size // 12, 1))], dtype=object)[rng.integers(0, max(library_size // 12, 1), size=library_size)]
+
+    library = pd.DataFrame({
+        'Track Identifier': 1_000_000_000 + rng.choice(np.arange(library_size * 10), size=library_size, replace=False),
+        'Song Name': titles,
+        'Artist Name': artists,
+        'Media Duration In Milliseconds': rng.integers(90_000, 420_000, size=library_size),
+    })
+    library['Track Description'] = library['Artist Name'] + ' - ' + library['Song Name']
+    return library
+
+
+def utc_offsets(timestamps: np.ndarray) -> np.ndarray:
+    """
+    Return the offset to UTC in seconds for every timestamp, alternating between winter and summer time like in central Europe.
+    """
+    months = timestamps.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    return np.where((months >= 4) & (months <= 10), 7200, 3600)
+
+
+def format_timestamps(timestamps: np.ndarray, offsets: np.ndarray, rng: np.random.Generator, timezone_quirks: bool) -> np.ndarray:
+    """
+    Format the timestamps in ISO 8601, mixing UTC, milliseconds and local times with an offset if timezone quirks are enabled.
+    """
+    formatted = np.datetime_as_string(timestamps.astype('datetime64[s]'), unit='s', timezone='UTC').astype(object)
+    if not timezone_quirks:
+        return formatted
+    styles = rng.integers(0, 3, size=len(timestamps))
+    milliseconds = styles == 1
+    formatted[milliseconds] = np.datetime_as_string(timestamps[milliseconds].astype('datetime64[ms]'), unit='ms', timezone='UTC')
+    local = styles == 2
+    local_times = np.datetime_as_string((timestamps[local] + offsets[local].astype('timedelta64[s]')).astype('datetime64[s]'), unit='s')
+    formatted[local] = local_times.astype(object) + np.where(offsets[local] == 7200, '+02:00', '+01:00').astype(object)
+    return formatted
+
+
+def generate_chunk(library: pd.DataFrame, popularity: np.ndarray, events: int, start: np.datetime64, end: np.datetime64, rng: np.random.Generator,
+                   skip_rate: float, timezone_quirks: bool) -> tuple:
+    """
+    Generate the streams of the listening sessions between start and end and the matching rows of the Daily Tracks file.
+    Within a session the next song is often the next one of the album or a repeat of the current one, so the graph has some structure.
+    """
+    # Split the streams into sessions with a geometric number of songs, each starting at a random time
+    session_lengths = rng.geometric(1 / 12, size=events)
+    session_lengths = session_lengths[:np.searchsorted(np.cumsum(session_lengths), events) + 1]
+    session_lengths[-1] -= session_lengths.sum() - events
+    session_starts = np.cumsum(session_lengths) - session_lengths
+    first = np.zeros(events, dtype=bool)
+    first[session_starts] = True
+
+    # Pick the songs, continuing the album or repeating the song within runs that start with a song drawn by its popularity
+    behaviour = rng.random(events)
+    advance = np.where(first, 0, np.where(behaviour < 0.3, 1, 0))
+    run_start = first | (behaviour >= 0.35)
+    run_start_index = np.maximum.accumulate(np.where(run_start, np.arange(events), 0))
+    picks = rng.choice(len(library), size=events, p=popularity)
+    steps = np.cumsum(advance) - np.cumsum(advance)[run_start_index]
+    songs = (picks[run_start_index] + steps) % len(library)
+
+    # Skip some streams and play the others mostly to their end
+    media_durations = library['Media Duration In Milliseconds'].to_numpy()[songs]
+    skipped = rng.random(events) < skip_rate
+    play_durations = np.where(skipped, rng.integers(1_000, 25_000, size=events), (media_durations * rng.uniform(0.5, 1.02, size=events)).astype(np.int64))
+    play_durations = np.minimum(play_durations, media_durations)
+
+    # Every session starts at a random time and its songs follow each other with short gaps
+    session_times = np.sort(rng.integers(0, (end - start).astype('timedelta64[ms]').astype(np.int64), size=len(session_lengths)))
+    gaps = np.where(first, 0, np.roll(play_durations, 1) + rng.integers(0, 10_000, size=events))
+    elapsed = np.cumsum(gaps) - np.repeat(np.cumsum(gaps)[session_starts], session_lengths)
+    timestamps = start + (np.repeat(session_times, session_lengths) + elapsed).astype('timedelta64[ms]')
+    order = np.argsort(timestamps, kind='stable')
+    timestamps, songs, play_durations, skipped = timestamps[order], songs[order], play_durations[order], skipped[order]
+    # Without timezone quirks everything happens in UTC, including the hours of the Daily Tracks file
+    offsets = utc_offsets(timestamps) if timezone_quirks else np.zeros(len(timestamps), dtype=np.int64)
+
+    # Some streams have no duration, no song name or a differently cased song name
+    names = library['Song Name'].to_numpy(dtype=object)[songs]
+    lowercase = rng.random(events) < 0.02
+    names[lowercase] = np.array([name.lower() for name in names[lowercase]], dtype=object)
+    names[rng.random(events) < 0.005] = None
+    play_durations = np.where(rng.random(events) < 0.01, 0, play_durations)
+    play_activity = pd.DataFrame({
+        'Album Name': np.array([f'{word} {song % 97}' for word, song in zip(rng.choice(ALBUM_WORDS, size=events), songs)], dtype=object),
+        'Event Start Timestamp': format_timestamps(timestamps, offsets, rng, timezone_quirks),
+        'Song Name': names,
+        'Play Duration Milliseconds': play_durations,
+        'Media Duration In Milliseconds': library['Media Duration In Milliseconds'].to_numpy()[songs],
+        'End Reason Type': np.where(skipped, 'TRACK_SKIPPED_FORWARDS', 'NATURAL_END_OF_TRACK'),
+        'UTC Offset In Seconds': offsets,
+    })
+
+    # The Daily Tracks file misses some streams and only knows the hours they were played in, in local time if timezone quirks are enabled
+    daily = rng.random(events) >= 0.1
+    hours = (timestamps[daily] + offsets[daily].astype('timedelta64[s]')).astype('datetime64[h]')
+    daily_tracks = pd.DataFrame({
+        'Date Played': np.datetime_as_string(hours.astype('datetime64[D]')).astype(object),
+        'Hour': (hours - hours.astype('datetime64[D]')).astype(np.int64),
+        'Track Identifier': library['Track Identifier'].to_numpy()[songs[daily]],
+        'Track Description': library['Track Description'].to_numpy(dtype=object)[songs[daily]],
+    }).drop_duplicates().sort_values(['Date Played', 'Track Identifier', 'Hour'])
+    daily_tracks['Hour'] = daily_tracks['Hour'].astype(str)
+    daily_tracks = daily_tracks.groupby(['Date Played', 'Track Identifier', 'Track Description'], sort=False)['Hour'].agg(','.join).reset_index(name='Hours')
+    daily_tracks['Date Played'] = daily_tracks['Date Played'].str.replace('-', '')
+    daily_tracks['Source Type'] = 'IPHONE'
+    daily_tracks = daily_tracks.sample(frac=1, random_state=rng.integers(2 ** 32))
+    return play_activity, daily_tracks[['Date Played', 'Hours', 'Source Type', 'Track Description', 'Track Identifier']]
+
+
+def generate_data(play_activity_path: str, daily_tracks_path: str, events: int = 100_000, library_size: int = None, skip_rate: float = 0.2,
+                  timezone_quirks: bool = True, days: int = None, seed: int = 0, chunk_events: int = 1_000_000):
+    """
+    Generate a Play Activity and a Play History Daily Tracks file with the given number of streams, written in chunks of days so that even
+    10 million streams never have to fit into memory at once. The library size and the number of days grow with the number of streams by default.
+    """
+    rng = np.random.default_rng(seed)
+    library_size = library_size or max(events // 40, 200)
+    days = days or max(events // 50, 30)
+    library = generate_library(library_size, rng)
+
+    # The popularity of the songs follows Zipf's law
+    popularity = 1 / np.arange(1, library_size + 1) ** 1.1
+    popularity = rng.permutation(popularity / popularity.sum())
+
+    start = np.datetime64('2016-01-01T00:00:00', 'ms')
+    chunks = max(-(-events // chunk_events), 1)
+    for chunk in range(chunks):
+        chunk_start = start + np.timedelta64(days * chunk // chunks, 'D')
+        chunk_end = start + np.timedelta64(days * (chunk + 1) // chunks, 'D')
+        chunk_size = events * (chunk + 1) // chunks - events * chunk // chunks
+        play_activity, daily_tracks = generate_chunk(library, popularity, chunk_size, chunk_start, chunk_end, rng, skip_rate, timezone_quirks)
+        play_activity.to_csv(play_activity_path, mode='w' if chunk == 0 else 'a', header=chunk == 0, index=False)
+        daily_tracks.to_csv(daily_tracks_path, mode='w' if chunk == 0 else 'a', header=chunk == 0, index=False)
+        print(f'Generated {events * (chunk + 1) // chunks} of {events} streams...')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic Apple Music Play Activity and Play History Daily Tracks files.')
+    parser.add_argument('--events', type=int, default=100_000, help='number of streams')
+    parser.add_argument('--library-size', type=int, default=None, help='number of distinct songs, grows with the number of streams by default')
+    parser.add_argument('--skip-rate', type=float, default=0.2, help='share of streams skipped within 25 seconds')
+    parser.add_argument('--days', type=int, default=None, help='number of days the streams are spread over')
+    parser.add_argument('--no-timezone-quirks', action='store_true', help='only use UTC timestamps in both files')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'), help='directory of the generated files')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    generate_data(
+        os.path.join(args.output, f'play_activity_{args.events}.csv'), os.path.join(args.output, f'daily_tracks_{args.events}.csv'),
+        events=args.events, library_size=args.library_size, skip_rate=args.skip_rate, timezone_quirks=not args.no_timezone_quirks, days=args.days, seed=args.seed
+    )
@@ -0,0 +1,135 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+from urllib.parse import parse_qs, urlparse
+
+
+class MockAppleMusic:
+    """
+    Local stand-in for the Apple Music endpoints used by the export, which records the tracks added to every playlist.
+    Unavailable songs fail to be added with a 500 and are replaced by their equivalents, every throttle_every-th request is answered with a 429.
+    Every fail_after_add_every-th request adding tracks adds them but then fails, alternately with a 504 and by closing the connection without a response.
+    The first requests creating a playlist fail as given by create_failures, either with a 503 before creating it ('503') or after creating it with a 504 ('504')
+    or by closing the connection ('close').
+    """
+    def __init__(self, unavailable: set = (), equivalents: dict = None, throttle_every: int = 0, retry_after: float = 0, fail_after_add_every: int = 0,
+                 create_failures: tuple = ()):
+        self.unavailable = {str(song_id) for song_id in unavailable}
+        self.equivalents = {str(song_id): str(equivalent) for song_id, equivalent in (equivalents or {}).items()}
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.fail_after_add_every = fail_after_add_every
+        self.create_failures = list(create_failures)
+        self.playlists = {}
+        self.names = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status: int, body: dict = None, headers: dict = None):
+                data = json.dumps(body).encode() if body is not None else b''
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def throttled(self, kind: str) -> bool:
+                with mock.lock:
+                    mock.requests[kind] = mock.requests.get(kind, 0) + 1
+                    total = sum(mock.requests.values())
+                if mock.throttle_every and total % mock.throttle_every == 0:
+                    self.reply(429, {'errors': [{'status': '429'}]}, {'Retry-After': str(mock.retry_after)})
+                    return True
+                return False
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                path = urlparse(self.path).path
+                if path == '/v1/me/library/playlists':
+                    if self.throttled('create playlist'):
+                        return
+                    with mock.lock:
+                        failure = mock.create_failures.pop(0) if mock.create_failures else None
+                        if failure == '503':
+                            return self.reply(503, {'errors': [{'status': '503'}]})
+                        playlist_id = f'p.{len(mock.playlists) + 1}'
+                        mock.playlists[playlist_id] = []
+                        mock.names[playlist_id] = body.get('attributes', {}).get('name')
+                    if failure == '504':
+                        return self.reply(504, {'errors': [{'status': '504'}]})
+                    if failure == 'close':
+                        self.close_connection = True
+                        return
+                    return self.reply(201, {'data': [{'id': playlist_id, 'type': 'library-playlists'}]})
+
+                if self.throttled('add tracks'):
+                    return
+                playlist_id = path.split('/')[-2]
+                song_ids = [str(track['id']) for track in body.get('data', [])]
+                if playlist_id not in mock.playlists:
+                    return self.reply(404, {'errors': [{'status': '404'}]})
+                if any(song_id in mock.unavailable for song_id in song_ids):
+                    return self.reply(500, {'errors': [{'status': '500'}]})
+                with mock.lock:
+                    mock.playlists[playlist_id] += song_ids
+                    adds = mock.requests['add tracks']
+                if mock.fail_after_add_every and adds % mock.fail_after_add_every == 0:
+                    if adds // mock.fail_after_add_every % 2:
+                        return self.reply(504, {'errors': [{'status': '504'}]})
+                    self.close_connection = True
+                    return
+                self.reply(204)
+
+            def do_GET(self):
+                path, query = urlparse(self.path).path, parse_qs(urlparse(self.path).query)
+                if path == '/v1/me/library/playlists':
+                    if self.throttled('playlists'):
+                        return
+                    playlists = list(mock.names.items())
+                    offset, limit = int(query.get('offset', ['0'])[0]), int(query.get('limit', ['100'])[0])
+                    if not playlists:
+                        return self.reply(404, {'errors': [{'status': '404'}]})
+                    page = {'data': [{'id': playlist_id, 'type': 'library-playlists', 'attributes': {'name': name}} for playlist_id, name in playlists[offset:offset + limit]]}
+                    if offset + limit < len(playlists):
+                        page['next'] = f'{path}?offset={offset + limit}&limit={limit}'
+                    return self.reply(200, page)
+                if path.startswith('/v1/me/library/playlists/'):
+                    if self.throttled('playlist tracks'):
+                        return
+                    tracks = mock.playlists.get(path.split('/')[-2], [])
+                    offset, limit = int(query.get('offset', ['0'])[0]), int(query.get('limit', ['100'])[0])
+                    if not tracks:
+                        return self.reply(404, {'errors': [{'status': '404'}]})
+                    page = {'data': [{'id': f'i.{song_id}', 'type': 'library-songs', 'attributes': {'playParams': {'catalogId': song_id}}} for song_id in tracks[offset:offset + limit]]}
+                    if offset + limit < len(tracks):
+                        page['next'] = f'{path}?offset={offset + limit}&limit={limit}'
+                    return self.reply(200, page)
+                if 'ids' in query:
+                    if self.throttled('catalog'):
+                        return
+                    song_ids = query['ids'][0].split(',')
+                    return self.reply(200, {'data': [{'id': song_id, 'type': 'songs'} for song_id in song_ids if song_id not in mock.unavailable]})
+                if self.throttled('equivalents'):
+                    return
+                song_id = query['filter[equivalents]'][0]
+                self.reply(200, {'data': [{'id': mock.equivalents[song_id], 'type': 'songs'}] if song_id in mock.equivalents else []})
+
+        return Handler
@@ -0,0 +1,198 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import pandas as pd
+import random
+import sqlite3
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from calculate_optimal_path import export_path, find_best_path, graph_data, preprocess_data
+from crossreference import crossreference
+from export_playlist_to_apple_music import get_playlist_id_and_add_songs, resolve_songs
+from generate_data import generate_data
+from ingest import DAILY_TRACKS_COLUMNS, PLAY_ACTIVITY_COLUMNS, read_data
+from metrics import STAGES, stage
+from mock_apple_music import MockAppleMusic
+from storage import connect, read_crossreference, write_crossreference
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+DATA_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, 'data')
+# The digests of the results are the same on every machine and kept in the repository, the timings are only comparable on the same machine
+REFERENCE_FILE = os.path.join(BENCHMARK_DIRECTORY, 'reference.json')
+BASELINE_FILE = os.path.join(BENCHMARK_DIRECTORY, 'baselines.json')
+RESULTS_FILE = os.path.join(BENCHMARK_DIRECTORY, 'results.json')
+
+
+def digest(df: pd.DataFrame) -> str:
+    """
+    Hash the values of the DataFrame in order, independent of their dtypes.
+    """
+    hashes = pd.util.hash_pandas_object(df.astype(object).astype(str), index=False)
+    return hashlib.blake2b(hashes.to_numpy().tobytes(), digest_size=16).hexdigest()
+
+
+def load_json(filename: str) -> dict:
+    """
+    Load the json file, or return an empty dict if it does not exist yet.
+    """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_json(filename: str, data: dict):
+    """
+    Save the data to the json file.
+    """
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def upload(song_ids: list, host_songs: int) -> tuple:
+    """
+    Upload the songs to a local mock of Apple Music, where every 97th song is unavailable and every other of those has an equivalent.
+    Return whether the uploaded playlist matches the expected one exactly along with the digest of the uploaded songs.
+    """
+    unavailable = sorted(set(song_ids))[::97]
+    equivalents = {song_id: song_id + host_songs for song_id in unavailable[::2]}
+    with tempfile.TemporaryDirectory() as directory, MockAppleMusic(unavailable=unavailable, equivalents=equivalents) as mock:
+        with connect(os.path.join(directory, 'catalog.sqlite3')) as conn:
+            resolved = resolve_songs(conn, song_ids, host=mock.url)
+        playlist_id = get_playlist_id_and_add_songs(resolved, host=mock.url)
+        uploaded = mock.playlists[playlist_id]
+
+    expected = [str(equivalents.get(song_id, song_id)) for song_id in song_ids if song_id not in unavailable or song_id in equivalents]
+    return uploaded == expected, digest(pd.DataFrame({'Track Identifier': uploaded}))
+
+
+def run_pipeline(play_activity_path: str, daily_tracks_path: str, workers: int, starts: int, seed: int) -> dict:
+    """
+    Run every stage of the pipeline on the generated files while recording their metrics and return the digests of their results.
+    """
+    # Remove the cached files so that the csv files are parsed again
+    for filename in glob.glob(f'{os.path.splitext(play_activity_path)[0]}.*.feather*') + glob.glob(f'{os.path.splitext(daily_tracks_path)[0]}.*.feather*'):
+        os.remove(filename)
+
+    digests = {}
+    STAGES.clear()
+    with stage('ingest'):
+        play_activity = read_data(play_activity_path, columns=PLAY_ACTIVITY_COLUMNS)
+        daily_tracks = read_data(daily_tracks_path, columns=DAILY_TRACKS_COLUMNS)
+    matched_songs = crossreference(play_activity, daily_tracks, workers=workers)
+    digests['crossreference'] = digest(matched_songs[['Event Start Timestamp', 'Song Name', 'Track Identifier']])
+
+    with tempfile.TemporaryDirectory() as directory:
+        with stage('store'), connect(os.path.join(directory, 'identified_songs.sqlite3')) as conn:
+            write_crossreference(conn, matched_songs, replace=True)
+            df = read_crossreference(conn)
+        with stage('preprocess'):
+            df = preprocess_data(df=df)
+        digests['preprocess'] = digest(df[['Event Start Timestamp', 'Song Name', 'Play Duration Milliseconds', 'Track Identifier']])
+
+        with stage('graph'):
+            random.seed(seed)
+            G = graph_data(df=df)
+        digests['graph'] = digest(pd.DataFrame(sorted((*sorted((source, target)), round(data['weight'], 6)) for source, target, data in G.edges(data=True))))
+
+        with stage('walk'):
+            path = find_best_path(G=G, starts=starts, seed=seed, workers=workers)
+        digests['path'] = digest(pd.DataFrame({'Song Name': path}))
+
+        with stage('export'):
+            export_path(df=df, path=path, export_path=os.path.join(directory, 'calculated_path.sqlite3'))
+            with sqlite3.connect(os.path.join(directory, 'calculated_path.sqlite3')) as conn:
+                song_ids = pd.read_sql('SELECT "Track Identifier" FROM exported_path', conn)['Track Identifier'].astype(int).tolist()
+    with stage('upload'):
+        upload_matches, digests['upload'] = upload(song_ids, host_songs=10 ** 10)
+
+    return {
+        'stages': {entry['Stage']: entry for entry in STAGES},
+        'digests': digests,
+        'upload order preserved': upload_matches,
+    }
+
+
+def fastest(results: list) -> dict:
+    """
+    Combine the results of repeated runs, keeping the fastest run of every stage as the timings of a single run are noisy.
+    Every run has to produce the same results, otherwise the results differ from the reference of the repeated runs.
+    """
+    combined = dict(results[0], stages={name: min((result['stages'][name] for result in results), key=lambda entry: entry['Wall Seconds']) for name in results[0]['stages']})
+    for result in results[1:]:
+        combined['digests'] = {name: value if result['digests'][name] == value else 'differs between runs' for name, value in combined['digests'].items()}
+        combined['upload order preserved'] &= result['upload order preserved']
+    return combined
+
+
+def compare(key: str, result: dict, reference: dict, baselines: dict, tolerance: float, noise: float = 0.1) -> list:
+    """
+    Compare the result with the reference digests and the baseline timings and return the problems found.
+    """
+    problems = []
+    if not result['upload order preserved']:
+        problems.append(f'{key}: the uploaded playlist does not match the calculated path')
+    for name, value in result['digests'].items():
+        if name in reference.get(key, {}) and reference[key][name] != value:
+            problems.append(f'{key}: the result of {name} differs from the reference')
+
+    print(f'\n{"Stage":<16}{"Wall":>10}{"CPU":>10}{"Peak RSS":>12}{"Baseline":>10}{"Change":>10}')
+    for name, entry in result['stages'].items():
+        baseline = baselines.get(key, {}).get(name)
+        change = f'{(entry["Wall Seconds"] / baseline - 1) * 100:+.0f}%' if baseline else ''
+        peak = f'{entry["Peak RSS Bytes"] / 2 ** 20:.0f} MiB' if entry['Peak RSS Bytes'] is not None else ''
+        print(f'{name:<16}{entry["Wall Seconds"]:>9.2f}s{entry["CPU Seconds"]:>9.2f}s{peak:>12}{f"{baseline:.2f}s" if baseline else "":>10}{change:>10}')
+        if baseline and entry['Wall Seconds'] > baseline * (1 + tolerance) and entry['Wall Seconds'] - baseline > noise:
+            problems.append(f'{key}: {name} regressed from {baseline:.2f}s to {entry["Wall Seconds"]:.2f}s')
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time every stage of the pipeline on synthetic data and check the results against the reference.')
+    parser.add_argument('--scales', default='10000,100000', help='comma-separated numbers of streams, e.g. 10000,100000,1000000,10000000')
+    parser.add_argument('--library-size', type=int, default=None, help='number of distinct songs, grows with the number of streams by default')
+    parser.add_argument('--skip-rate', type=float, default=0.2, help='share of streams skipped within 25 seconds')
+    parser.add_argument('--no-timezone-quirks', action='store_true', help='only use UTC timestamps in both files')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes of the crossreference and the walk')
+    parser.add_argument('--starts', type=int, default=4, help='number of start nodes of the walk')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs per scale, the fastest run of every stage is kept')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown of a stage which is flagged as a regression')
+    parser.add_argument('--update-reference', action='store_true', help='store the digests of the results as the new reference')
+    parser.add_argument('--update-baselines', action='store_true', help='store the timings as the new baselines of this machine')
+    args = parser.parse_args()
+
+    reference, baselines, results, problems = load_json(REFERENCE_FILE), load_json(BASELINE_FILE), {}, []
+    os.makedirs(DATA_DIRECTORY, exist_ok=True)
+    for events in (int(scale) for scale in args.scales.split(',')):
+        # The results only depend on the parameters of the generated data and the walk
+        key = f'{events}-{args.library_size or "auto"}-{args.skip_rate}-{"utc" if args.no_timezone_quirks else "quirks"}-{args.seed}-{args.starts}'
+        play_activity_path = os.path.join(DATA_DIRECTORY, f'play_activity_{key}.csv')
+        daily_tracks_path = os.path.join(DATA_DIRECTORY, f'daily_tracks_{key}.csv')
+        if not (os.path.exists(play_activity_path) and os.path.exists(daily_tracks_path)):
+            generate_data(play_activity_path, daily_tracks_path, events=events, library_size=args.library_size, skip_rate=args.skip_rate,
+                          timezone_quirks=not args.no_timezone_quirks, seed=args.seed)
+
+        print(f'\nRunning the pipeline on {events} streams {args.repeat} times...')
+        results[key] = fastest([run_pipeline(play_activity_path, daily_tracks_path, workers=args.workers, starts=args.starts, seed=args.seed) for _ in range(args.repeat)])
+        problems += compare(key, results[key], reference, baselines, args.tolerance)
+        if args.update_reference:
+            reference[key] = results[key]['digests']
+        if args.update_baselines:
+            baselines[key] = {name: entry['Wall Seconds'] for name, entry in results[key]['stages'].items()}
+
+    save_json(RESULTS_FILE, results)
+    if args.update_reference:
+        save_json(REFERENCE_FILE, reference)
+    if args.update_baselines:
+        save_json(BASELINE_FILE, baselines)
+
+    print()
+    for problem in problems:
+        print(f'IMPORTANT: {problem}')
+    print(f'Found {len(problems)} problems.' if problems else 'All results match the reference and no stage regressed.')
+    sys.exit(1 if problems else 0)
@@ -1,31 +1,78 @@
+from concurrent.futures import ProcessPoolExecutor
 import csv
+import heapq
+from metrics import COUNTERS, count, dump_metrics, stage
 import networkx as nx
 import numpy as np
+import os
 import pandas as pd
 import random
 import sqlite3
+from storage import (
+    TRANSITIONS_WATERMARK_TABLE, clear_transitions, compact_streams, connect, read_crossreference, read_song_totals, read_transitions,
+    read_transitions_state, read_watermark, streams_checksum, to_millisecond, update_song_totals, update_transitions, write_transitions_state,
+    write_watermark
+)
+import time
+from typing import NamedTuple
 
 
-def preprocess_data(df: pd.DataFrame) -> pd.DataFrame:
+def select_date_range(df: pd.DataFrame, start: pd.Timestamp = None, end: pd.Timestamp = None) -> pd.DataFrame:
     """
-    Preprocess the data by removing streams that are too short, have no track identifier or have been played for less than 5 minutes in total.
+    Select the streams within the date range [start, end), either bound can be left open.
     """
-    df['Event Start Timestamp'] = pd.to_datetime(df['Event Start Timestamp'], format='ISO8601').dt.tz_localize(None)
+    timestamps = df['Event Start Timestamp']
+    selected = pd.Series(True, index=df.index)
+    if start is not None:
+        selected &= timestamps >= start
+    if end is not None:
+        selected &= timestamps < end
+    print(f'Selected {selected.sum()} of {len(df)} streams between {start or "the first"} and {end or "the last"} stream.')
+    return df[selected]
+
+
+def session_starts(df: pd.DataFrame) -> np.ndarray:
+    """
+    Return the positions of the streams that start a song session, which continues while the track stays the same and the next stream starts within 3 minutes.
+    """
+    timestamps = df['Event Start Timestamp'].to_numpy(dtype='datetime64[ns]').view('int64')
+    identifiers = df['Track Identifier'].to_numpy(dtype='int64', na_value=0)
+    identified = df['Track Identifier'].notna().to_numpy()
+    same_session = identified[1:] & identified[:-1] & (identifiers[1:] == identifiers[:-1]) & (np.diff(timestamps) <= 180_000_000_000)
+    return np.flatnonzero(np.concatenate([[True], ~same_session])) if len(df) else np.zeros(0, dtype=np.int64)
+
+
+def merge_sessions(df: pd.DataFrame, starts: np.ndarray = None) -> pd.DataFrame:
+    """
+    Merge the streams of every song session into its first stream, adding their play durations together.
+    """
+    starts = session_starts(df) if starts is None else starts
+    play_durations = df['Play Duration Milliseconds'].to_numpy(dtype='int64', na_value=0)
+    play_durations = np.add.reduceat(play_durations, starts) if len(df) else play_durations
+    return df.iloc[starts].assign(**{'Play Duration Milliseconds': pd.array(play_durations, dtype='Int32')})
+
+
+def preprocess_data(df: pd.DataFrame, skip_threshold: pd.Timedelta = pd.Timedelta(seconds=25), minimum_playtime: pd.Timedelta = pd.Timedelta(minutes=5)) -> pd.DataFrame:
+    """
+    Preprocess the data by removing streams that are skipped, have no track identifier or whose song has been played for less than the minimum playtime in total.
+    The sessions are merged and the streams filtered in a single pass over the integer codes of the compact columns, without any temporary columns.
+    """
+    df = compact_streams(df.assign(**{'Event Start Timestamp': pd.to_datetime(df['Event Start Timestamp'], format='ISO8601').dt.tz_localize(None)}))
     print(f'Number of songs: {len(df)}, unique: {len(df["Track Identifier"].unique())}, starting preprocessing...')
 
     # Add the streams that belong to the same song session together
-    df['Time Difference Milliseconds'] = df['Event Start Timestamp'].diff().dt.total_seconds() * 1000
-    df['Is Same Song Session'] = df['Track Identifier'].eq(df['Track Identifier'].shift()) & (df['Time Difference Milliseconds'] <= 180000)
-    df['Play Duration Milliseconds'] = df.groupby((~df['Is Same Song Session']).cumsum())['Play Duration Milliseconds'].transform('sum')
-    df = df[~df['Is Same Song Session']].drop(columns=['Time Difference Milliseconds', 'Is Same Song Session'])
-
-    # Remove streams which are too short, have no track identifier, have been played for less than 5 minutes in total or only once in total
-    df = df[
-        (df['Play Duration Milliseconds'] > 25000) &
-        (df['Track Identifier'].notna()) &
-        (df.groupby('Song Name')['Play Duration Milliseconds'].transform('sum') > 300000) &
-        (df.groupby('Song Name')['Song Name'].transform('count') > 1)
-    ]
+    df = merge_sessions(df)
+
+    # Remove streams which are skipped, have no track identifier, have been played for less than the minimum playtime in total or only once in total
+    play_durations = df['Play Duration Milliseconds'].to_numpy(dtype='int64', na_value=0)
+    identified = df['Track Identifier'].notna().to_numpy()
+    codes = df['Song Name'].cat.codes.to_numpy()
+    named = codes >= 0
+    totals = np.bincount(codes[named], weights=play_durations[named], minlength=len(df['Song Name'].cat.categories))
+    counts = np.bincount(codes[named], minlength=len(df['Song Name'].cat.categories))
+    codes = np.where(named, codes, 0)
+    skip_milliseconds, minimum_milliseconds = skip_threshold // pd.Timedelta(milliseconds=1), minimum_playtime // pd.Timedelta(milliseconds=1)
+    df = df[(play_durations > skip_milliseconds) & identified & named & (totals[codes] > minimum_milliseconds) & (counts[codes] > 1)]
 
     print(f'Number of songs: {len(df)}, unique: {len(df["Track Identifier"].unique())}, finished preprocessing.')
     return df
@@ -47,9 +94,201 @@ def graph_data(df: pd.DataFrame) -> nx.Graph:
     return G
 
 
-def find_path(G: nx.Graph, start_node: str) -> list:
+def aggregate_transitions(df: pd.DataFrame, watermark: pd.Timestamp = pd.Timestamp.min) -> pd.DataFrame:
     """
-    Find the best path in the graph using a greedy algorithm, jump to the closest unvisited node if no unvisited neighbors are available.
+    Aggregate the transitions between consecutive songs which happened after the watermark per pair of songs.
+    Like in graph_data, each transition adds 1 plus some random fuzz to the weight of the edge between the two songs.
+    """
+    songs = df['Song Name'].to_numpy(dtype=object)
+    timestamps = df['Event Start Timestamp'].to_numpy()
+    new = timestamps[1:] > np.datetime64(watermark) if watermark != pd.Timestamp.min else np.ones(max(len(df) - 1, 0), dtype=bool)
+    sources, targets = songs[:-1][new], songs[1:][new]
+
+    # Aggregate the new transitions per pair of songs, with the names in sorted order as the graph is undirected
+    transitions = pd.DataFrame({
+        'Source': np.where(sources <= targets, sources, targets),
+        'Target': np.where(sources <= targets, targets, sources),
+        'Weight': [random.uniform(0.95, 1.05) for _ in range(len(sources))],
+        'Last Seen Timestamp': timestamps[1:][new],
+    })
+    return transitions.groupby(['Source', 'Target'], sort=False).agg(**{
+        'Count': ('Weight', 'size'),
+        'Weight': ('Weight', 'sum'),
+        'Last Seen Timestamp': ('Last Seen Timestamp', 'max'),
+    }).reset_index()
+
+
+def fold_transitions(conn: sqlite3.Connection, skip_threshold: pd.Timedelta = pd.Timedelta(seconds=25)) -> int:
+    """
+    Fold the streams after the transitions watermark into the transition store and the per-song totals, and return the number of new transitions.
+    Only the sessions that are not skipped and have a track identifier are linked, the minimum playtime and play count filters of preprocess_data
+    are applied when reading the store instead, so a song passing them later on does not invalidate the stored transitions. The last session is
+    held back until the next one starts, as it might still continue. Only if earlier streams were deleted or changed is the store rebuilt.
+    """
+    skip_milliseconds = skip_threshold // pd.Timedelta(milliseconds=1)
+    state = read_transitions_state(conn)
+    watermark = read_watermark(conn, TRANSITIONS_WATERMARK_TABLE)
+    if state is None or state['Skip Threshold Milliseconds'] != skip_milliseconds or (state['Streams'], state['Identifier Sum'], state['Duration Sum']) != streams_checksum(conn, watermark):
+        if state is not None:
+            print('Earlier streams were deleted or changed since the transitions were stored, rebuilding the transition store...')
+        clear_transitions(conn)
+        state, watermark = None, pd.Timestamp.min
+
+    # Read only the new streams and hold back the last session, cutting where the timestamp changes so no stream is split from its equals
+    df = read_crossreference(conn, start=watermark + pd.Timedelta(milliseconds=1) if watermark != pd.Timestamp.min else None)
+    starts = session_starts(df)
+    timestamps = df['Event Start Timestamp'].to_numpy()
+    cuts = starts[(starts > 0) & (timestamps[starts] > timestamps[np.maximum(starts - 1, 0)])]
+    if not len(cuts):
+        print('Folded 0 new transitions into the transition store.')
+        return 0
+    df, starts = df.iloc[:cuts[-1]], starts[starts < cuts[-1]]
+    sessions = merge_sessions(df, starts)
+
+    # Add the playtime and number of sessions of every song, keeping the Track Identifier and Media Duration of its first kept session
+    named = sessions[sessions['Song Name'].notna()]
+    named = named.assign(**{'Play Duration Milliseconds': named['Play Duration Milliseconds'].astype('int64')})
+    kept = named[(named['Play Duration Milliseconds'] > skip_milliseconds) & named['Track Identifier'].notna()]
+    totals = named.groupby('Song Name', observed=True, sort=False).agg(**{
+        'Playtime Milliseconds': ('Play Duration Milliseconds', 'sum'),
+        'Plays': ('Play Duration Milliseconds', 'size'),
+    }).join(kept.drop_duplicates(subset='Song Name').set_index('Song Name')[['Track Identifier', 'Media Duration In Milliseconds']]).reset_index()
+    update_song_totals(conn, totals)
+
+    # Link the kept sessions, starting from the last kept session of the previous fold
+    songs = kept[['Event Start Timestamp', 'Song Name']].astype({'Song Name': object})
+    if state is not None and state['Last Song Name'] is not None:
+        previous = pd.DataFrame({'Event Start Timestamp': [pd.to_datetime(state['Last Timestamp'], unit='ms')], 'Song Name': [state['Last Song Name']]})
+        songs = pd.concat([previous, songs], ignore_index=True)
+    transitions = aggregate_transitions(songs)
+    update_transitions(conn, transitions)
+
+    watermark = df['Event Start Timestamp'].iloc[-1]
+    write_watermark(conn, watermark, TRANSITIONS_WATERMARK_TABLE)
+    streams, identifier_sum, duration_sum = streams_checksum(conn, watermark)
+    write_transitions_state(conn, {
+        'Skip Threshold Milliseconds': skip_milliseconds,
+        'Last Song Name': songs['Song Name'].iloc[-1] if len(songs) else None,
+        'Last Timestamp': to_millisecond(songs['Event Start Timestamp'].iloc[-1]) if len(songs) else None,
+        'Streams': streams, 'Identifier Sum': identifier_sum, 'Duration Sum': duration_sum,
+    })
+    print(f'Folded {int(transitions["Count"].sum())} new transitions of {len(df)} streams into the transition store.')
+    return int(transitions['Count'].sum())
+
+
+def graph_from_transitions(transitions: pd.DataFrame, half_life: pd.Timedelta = None) -> nx.Graph:
+    """
+    Create the graph from the stored transitions, optionally halving the weight of each transition for every half-life since it was last seen.
+    """
+    weights = transitions['Weight']
+    if half_life is not None:
+        age = transitions['Last Seen Timestamp'].max() - transitions['Last Seen Timestamp']
+        weights = weights * 0.5 ** (age / half_life)
+
+    G = nx.Graph()
+    G.add_weighted_edges_from(zip(transitions['Source'], transitions['Target'], weights))
+    print(f'Created graph with {len(G.nodes())} nodes and {len(G.edges())} edges.')
+    return G
+
+
+class CSRGraph(NamedTuple):
+    """
+    Compact undirected graph in compressed sparse row format, where node i is the song names[i].
+    The neighbors of node i are indices[indptr[i]:indptr[i + 1]] with the edge weights at the same positions.
+    The weighted degrees are kept in full precision, as they decide the jumps between nearly equal candidates.
+    """
+    names: np.ndarray
+    indptr: np.ndarray
+    indices: np.ndarray
+    weights: np.ndarray
+    degrees: np.ndarray
+
+    def edge_weights(self) -> np.ndarray:
+        """
+        Return the weight of every edge once.
+        """
+        rows = np.repeat(np.arange(len(self.names)), np.diff(self.indptr))
+        return self.weights[rows <= self.indices]
+
+
+def graph_data_csr(df: pd.DataFrame) -> CSRGraph:
+    """
+    Create the same graph as graph_data in the compact CSR format, aggregating the transitions between the songs with numpy instead of one networkx call per transition.
+    """
+    # Map the song names to integer ids in the order of their first appearance
+    ids, names = pd.factorize(df['Song Name'])
+    ids = ids.astype(np.int32)
+
+    # Every transition adds 1 plus some random fuzz to the weight of the edge between the two songs
+    low, high = np.minimum(ids[:-1], ids[1:]).astype(np.int64), np.maximum(ids[:-1], ids[1:]).astype(np.int64)
+    edges, inverse = np.unique(low * len(names) + high, return_inverse=True)
+    weights = np.zeros(len(edges))
+    np.add.at(weights, inverse, [random.uniform(0.95, 1.05) for _ in range(len(inverse))])
+
+    # Store every edge in both directions, but self-loops only once, and count self-loops twice for the weighted degrees like networkx
+    low, high = edges // len(names), edges % len(names)
+    both = low != high
+    rows = np.concatenate([low, high[both]])
+    columns = np.concatenate([high, low[both]])
+    degrees = np.bincount(rows, weights=np.concatenate([np.where(both, 1, 2) * weights, weights[both]]), minlength=len(names))
+    weights = np.concatenate([weights, weights[both]]).astype(np.float32)
+    order = np.lexsort((columns, rows))
+    indptr = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(names)), out=indptr[1:])
+
+    print(f'Created graph with {len(names)} nodes and {len(edges)} edges.')
+    return CSRGraph(np.asarray(names, dtype=object), indptr, columns[order].astype(np.int32), weights[order], degrees)
+
+
+def csr_to_networkx(graph: CSRGraph) -> nx.Graph:
+    """
+    Convert the CSR graph to a networkx graph, e.g. to export it.
+    """
+    G = nx.Graph()
+    G.add_nodes_from(graph.names)
+    rows = np.repeat(np.arange(len(graph.names)), np.diff(graph.indptr))
+    edges = rows <= graph.indices
+    G.add_weighted_edges_from(zip(graph.names[rows[edges]], graph.names[graph.indices[edges]], graph.weights[edges].tolist()))
+    return G
+
+
+def first_unvisited(ranked_neighbors: dict, next_neighbors: dict, node: str, visited: set) -> str:
+    """
+    Return the first unvisited neighbor of the node in the ranked order, or None if all are visited.
+    Visited neighbors are skipped for good by advancing the node's pointer, as they stay visited.
+    """
+    neighbors, index = ranked_neighbors[node], next_neighbors[node]
+    while index < len(neighbors) and neighbors[index] in visited:
+        index += 1
+    next_neighbors[node] = index
+    return neighbors[index] if index < len(neighbors) else None
+
+
+def nearest_unvisited(G: nx.Graph, source: str, visited: set, ranked_neighbors: dict, next_neighbors: dict, ranks: dict) -> tuple:
+    """
+    Find the best ranked unvisited node closest to the source and its distance, using a breadth-first search which stops at the first distance containing any.
+    Any unvisited neighbor of a node at the current distance is exactly one step further, so only the best unvisited neighbor of each node has to be checked.
+    """
+    seen, level, distance = {source}, [source], 0
+    while level:
+        distance += 1
+        candidates = [neighbor for neighbor in (first_unvisited(ranked_neighbors, next_neighbors, node, visited) for node in level) if neighbor is not None]
+        if candidates:
+            return min(candidates, key=ranks.get), distance
+        next_level = []
+        for node in level:
+            for neighbor in G[node]:
+                if neighbor not in seen:
+                    seen.add(neighbor)
+                    next_level.append(neighbor)
+        level = next_level
+    return None, None
+
+
+def walk_path(G: nx.Graph, start_node: str) -> tuple:
+    """
+    Walk the graph from the start node using a greedy algorithm, jump to the closest unvisited node if no unvisited neighbors are available.
+    Return the path along with its total weight and number of jumps.
     """
     path = [start_node]
     visited = set(path)
@@ -58,40 +297,350 @@ def find_path(G: nx.Graph, start_node: str) -> list:
     edge_weights = nx.get_edge_attributes(G, 'weight').values()
     median_weight = np.median(list(edge_weights))
 
-    # Precompute the shortest paths between each node
-    print('Precomputing shortest paths...') 
-    shortest_paths = dict(nx.all_pairs_shortest_path_length(G))
+    # Rank the nodes by their weighted degree and position for the jumps
+    ranks = {node: (-degree, position) for position, (node, degree) in enumerate(G.degree(weight='weight'))}
+
+    # Sort the neighbors of each node once, by weight for the walk and by rank for the jumps
+    heaviest_neighbors = {node: sorted(G[node], key=lambda neighbor: -G[node][neighbor]['weight']) for node in G.nodes()}
+    best_ranked_neighbors = {node: sorted(G[node], key=ranks.get) for node in G.nodes()}
+    next_heaviest, next_best_ranked = dict.fromkeys(G.nodes(), 0), dict.fromkeys(G.nodes(), 0)
+
+    # Keep all nodes in a heap by rank to find the best unvisited node of the graph in logarithmic time
+    # and count the unvisited nodes of each component to know when no unvisited node is reachable
+    jump_heap = [(rank, node) for node, rank in ranks.items()]
+    heapq.heapify(jump_heap)
+    components, unvisited_counts = {}, []
+    for component in nx.connected_components(G):
+        components.update(dict.fromkeys(component, len(unvisited_counts)))
+        unvisited_counts.append(len(component))
+    unvisited_counts[components[start_node]] -= 1
 
     current_node = start_node
     total_weight, total_jumps = 0, 0
 
-    print('Finding optimal path...')
     while len(visited) < len(G.nodes()):
         # Find the heaviest unvisited neighbor
-        neighbors = [(neighbor, G[current_node][neighbor]['weight'])
-                        for neighbor in G.neighbors(current_node)
-                        if neighbor not in visited]
-        if neighbors:
-            next_node, weight = max(neighbors, key=lambda x: x[1])
-            total_weight += weight
-        else:
+        next_node = first_unvisited(heaviest_neighbors, next_heaviest, current_node, visited)
+        if next_node is not None:
+            total_weight += G[current_node][next_node]['weight']
+        elif unvisited_counts[components[current_node]]:
             # Find the closest unvisited neighbor with the highest degree
-            neighbors = [(node, shortest_paths[current_node][node]) for node in G.nodes() if node not in visited]
-            next_node, path_length = min(neighbors, key=lambda x: (x[1], -G.degree(x[0], weight='weight')))
-            
+            search_start = time.perf_counter()
+            next_node, path_length = nearest_unvisited(G, current_node, visited, best_ranked_neighbors, next_best_ranked, ranks)
+            count('shortest path searches')
+            count('shortest path seconds', time.perf_counter() - search_start)
+
             # Add the average weight of the graph in case of a jump
-            total_weight += median_weight *  (1 / path_length)
+            total_weight += median_weight * (1 / path_length)
+            total_jumps += 1
+        else:
+            # Jump to the unvisited node with the highest degree if none are reachable
+            while jump_heap[0][1] in visited:
+                heapq.heappop(jump_heap)
+            next_node = jump_heap[0][1]
             total_jumps += 1
 
         # Visit the next node
         path.append(next_node)
         visited.add(next_node)
+        unvisited_counts[components[next_node]] -= 1
         current_node = next_node
 
+    return path, total_weight, total_jumps
+
+
+def find_path(G: nx.Graph, start_node: str) -> list:
+    """
+    Find the best path in the graph using a greedy algorithm, jump to the closest unvisited node if no unvisited neighbors are available.
+    """
+    print('Finding optimal path...')
+    path, total_weight, total_jumps = walk_path(G, start_node)
+    count('jumps', total_jumps)
     print(f'Found path with {len(path)} songs, {total_jumps} jumps and a total weight of {total_weight}.')
     return path
 
 
+def _init_worker(G: nx.Graph):
+    global _worker_graph
+    _worker_graph = G
+
+
+def _walk_from(start_node: str) -> tuple:
+    # Return the counters of the walk along with its result, as the counters of the worker process are not shared
+    COUNTERS.clear()
+    return walk_path(_worker_graph, start_node), dict(COUNTERS)
+
+
+def find_best_path(G: nx.Graph, starts: int = 8, strategy: str = 'random', seed: int = None, workers: int = None) -> list:
+    """
+    Walk the graph from several start nodes in a pool of worker processes and return the path with the highest total weight and the fewest jumps.
+    The start nodes are either drawn at random using the seed, which is reported for reproducibility, or the nodes with the highest degree.
+    """
+    if strategy == 'degree':
+        start_nodes = [node for node, _ in sorted(G.degree(weight='weight'), key=lambda x: -x[1])[:starts]]
+    else:
+        seed = random.randrange(2 ** 32) if seed is None else seed
+        start_nodes = random.Random(seed).sample(list(G.nodes()), min(starts, len(G.nodes())))
+        print(f'Drawing {len(start_nodes)} start nodes with seed {seed}')
+
+    # The graph is sent to every worker once and shared by all its walks
+    print(f'Finding optimal path from {len(start_nodes)} start nodes...')
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(G,)) as executor:
+        results = []
+        for result, counters in executor.map(_walk_from, start_nodes):
+            results.append(result)
+            for name, value in counters.items():
+                count(name, value)
+    for start_node, (path, total_weight, total_jumps) in zip(start_nodes, results):
+        print(f'Start node {start_node}: {total_jumps} jumps and a total weight of {total_weight}')
+
+    # Keep the path with the highest total weight and the fewest jumps, the first one in case of a tie
+    best = min(range(len(results)), key=lambda i: (-results[i][1], results[i][2], i))
+    path, total_weight, total_jumps = results[best]
+    count('jumps', total_jumps)
+    print(f'Found path with {len(path)} songs from start node {start_nodes[best]}, {total_jumps} jumps and a total weight of {total_weight}.')
+    return path
+
+
+def find_path_csr(graph: CSRGraph, start_node: str) -> list:
+    """
+    Find the best path in the CSR graph with the same greedy algorithm as find_path.
+    """
+    indptr, indices, weights = graph.indptr, graph.indices, graph.weights
+    node_count = len(graph.names)
+    start = int(np.flatnonzero(graph.names == start_node)[0])
+    path = [start]
+    visited = np.zeros(node_count, dtype=bool)
+    visited[start] = True
+
+    # Find the median weight of the graph and precompute the weighted degrees for the jumps
+    median_weight = np.median(graph.edge_weights())
+    degrees = graph.degrees
+
+    current_node = start
+    total_weight, total_jumps = 0, 0
+
+    print('Finding optimal path...')
+    while len(path) < node_count:
+        # Find the heaviest unvisited neighbor
+        neighbors = indices[indptr[current_node]:indptr[current_node + 1]]
+        unvisited = ~visited[neighbors]
+        if unvisited.any():
+            neighbor_weights = weights[indptr[current_node]:indptr[current_node + 1]][unvisited]
+            best = int(np.argmax(neighbor_weights))
+            next_node = int(neighbors[unvisited][best])
+            total_weight += float(neighbor_weights[best])
+        else:
+            # Find the closest unvisited nodes with a breadth-first search, or all unvisited nodes if none are reachable
+            seen = np.zeros(node_count, dtype=bool)
+            seen[current_node] = True
+            level, path_length, candidates = np.array([current_node]), 0, np.zeros(0, dtype=np.int64)
+            while len(level) and not len(candidates):
+                path_length += 1
+                counts = indptr[level + 1] - indptr[level]
+                level = indices[np.repeat(indptr[level] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+                level = np.unique(level[~seen[level]])
+                seen[level] = True
+                candidates = level[~visited[level]]
+            if not len(candidates):
+                candidates, path_length = np.flatnonzero(~visited), None
+
+            # Jump to the candidate with the highest degree, the first one in case of a tie
+            next_node = int(candidates[np.argmax(degrees[candidates])])
+            total_weight += median_weight * (1 / path_length) if path_length else 0
+            total_jumps += 1
+
+        # Visit the next node
+        path.append(next_node)
+        visited[next_node] = True
+        current_node = next_node
+
+    count('jumps', total_jumps)
+    print(f'Found path with {len(path)} songs, {total_jumps} jumps and a total weight of {total_weight}.')
+    return graph.names[path].tolist()
+
+
+def partition_graph(G: nx.Graph, method: str = 'components', seed: int = None) -> list:
+    """
+    Split the graph into its connected components, or into communities using 'louvain' or 'label_propagation', sorted by size.
+    """
+    if method == 'louvain':
+        partitions = nx.community.louvain_communities(G, weight='weight', seed=seed)
+    elif method == 'label_propagation':
+        partitions = nx.community.asyn_lpa_communities(G, weight='weight', seed=seed)
+    else:
+        partitions = nx.connected_components(G)
+
+    positions = {node: position for position, node in enumerate(G.nodes())}
+    return sorted(partitions, key=lambda partition: (-len(partition), min(positions[node] for node in partition)))
+
+
+def _walk_partition(G: nx.Graph) -> list:
+    # Start each partition at its node with the highest degree, the first one in case of a tie
+    degrees = list(G.degree(weight='weight'))
+    start_node = min(range(len(degrees)), key=lambda i: (-degrees[i][1], i))
+    return walk_path(G, degrees[start_node][0])[0]
+
+
+def find_partition_paths(G: nx.Graph, method: str = 'components', seed: int = None, workers: int = None) -> list:
+    """
+    Find a path for each partition of the graph independently in a pool of worker processes, each of which only receives the subgraph of its partition.
+    """
+    partitions = partition_graph(G, method=method, seed=seed)
+    print(f'Finding optimal paths for {len(partitions)} partitions, the largest with {len(partitions[0]) if partitions else 0} songs...')
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_walk_partition, (G.subgraph(partition).copy() for partition in partitions)))
+
+
+def stitch_paths(G: nx.Graph, paths: list) -> list:
+    """
+    Join the paths of the partitions into one, always continuing with the partition that has the highest total edge weight to the previous one,
+    or the largest remaining one if none are connected, and orienting it so that the transition between the two is the heaviest.
+    """
+    if not paths:
+        return []
+    partitions = {node: index for index, path in enumerate(paths) for node in path}
+
+    # Sum the weights of the edges between each pair of partitions
+    affinities = {}
+    for source, target, weight in G.edges(data='weight'):
+        if partitions[source] != partitions[target]:
+            for pair in ((partitions[source], partitions[target]), (partitions[target], partitions[source])):
+                affinities.setdefault(pair[0], {}).setdefault(pair[1], 0)
+                affinities[pair[0]][pair[1]] += weight
+
+    stitched, current = list(paths[0]), 0
+    remaining = set(range(1, len(paths)))
+    while remaining:
+        current = max(remaining, key=lambda index: (affinities.get(current, {}).get(index, 0), len(paths[index]), -index))
+        remaining.remove(current)
+        path = paths[current]
+        if transition(G, stitched[-1], path[-1]) > transition(G, stitched[-1], path[0]):
+            path = path[::-1]
+        stitched.extend(path)
+
+    print(f'Stitched {len(paths)} paths into a path with {len(stitched)} songs.')
+    return stitched
+
+
+def transition(G: nx.Graph, source: str, target: str) -> tuple:
+    """
+    Return the weight of the transition between two songs and whether it is a jump, i.e. there is no edge between them.
+    """
+    data = G.get_edge_data(source, target)
+    return (data['weight'], 0) if data is not None else (0, 1)
+
+
+def score_path(G: nx.Graph, path: list) -> tuple:
+    """
+    Return the total transition weight and the number of jumps of the path.
+    """
+    transitions = [transition(G, source, target) for source, target in zip(path, path[1:])]
+    return sum(weight for weight, _ in transitions), sum(jump for _, jump in transitions)
+
+
+def _delta(G: nx.Graph, removed: list, added: list) -> tuple:
+    weight_delta, jump_delta = 0, 0
+    for source, target in added:
+        weight, jump = transition(G, source, target)
+        weight_delta, jump_delta = weight_delta + weight, jump_delta + jump
+    for source, target in removed:
+        weight, jump = transition(G, source, target)
+        weight_delta, jump_delta = weight_delta - weight, jump_delta - jump
+    return weight_delta, jump_delta
+
+
+def _improves(weight_delta: float, jump_delta: int) -> bool:
+    return (jump_delta < 0 and weight_delta > -1e-9) or (jump_delta <= 0 and weight_delta > 1e-9)
+
+
+def refine_path(G: nx.Graph, path: list, time_budget: float = 60, progress_interval: float = 5, max_segment_length: int = 3) -> list:
+    """
+    Improve the path with 2-opt and Or-opt moves which increase the total transition weight or remove jumps, until no move improves it or the time budget in seconds is used up.
+    Moves are only tried towards neighbors in the graph and evaluated by the change of the affected transitions instead of rescoring the whole path.
+    """
+    path = list(path)
+    positions = {node: position for position, node in enumerate(path)}
+    start_time = last_progress = time.monotonic()
+    total_weight, total_jumps = score_path(G, path)
+    print(f'Refining path with {total_jumps} jumps and a total transition weight of {total_weight} for up to {time_budget} seconds...')
+
+    moves, improved = 0, True
+    while improved and time.monotonic() - start_time < time_budget:
+        improved = False
+        for node in list(path):
+            if time.monotonic() - start_time >= time_budget:
+                break
+            if time.monotonic() - last_progress >= progress_interval:
+                last_progress = time.monotonic()
+                print(f'Refining path: {moves} moves, {total_jumps} jumps and a total transition weight of {total_weight} after {last_progress - start_time:.0f} seconds')
+            i = positions[node]
+
+            # 2-opt: reverse the segment between the node and one of its neighbors, so that they become adjacent
+            for neighbor in G[node]:
+                j = positions[neighbor]
+                if j > i + 1:
+                    left, right = i + 1, j
+                elif j < i - 1:
+                    left, right = j, i - 1
+                else:
+                    continue
+                removed = [(path[left - 1], path[left])] if left > 0 else []
+                added = [(path[left - 1], path[right])] if left > 0 else []
+                if right < len(path) - 1:
+                    removed.append((path[right], path[right + 1]))
+                    added.append((path[left], path[right + 1]))
+                weight_delta, jump_delta = _delta(G, removed, added)
+                if _improves(weight_delta, jump_delta):
+                    path[left:right + 1] = path[left:right + 1][::-1]
+                    positions.update((path[position], position) for position in range(left, right + 1))
+                    total_weight, total_jumps, moves, improved = total_weight + weight_delta, total_jumps + jump_delta, moves + 1, True
+                    i = positions[node]
+
+            # Or-opt: move the segment starting at the node next to a neighbor of its first or last song, in either orientation
+            for length in range(1, max_segment_length + 1):
+                if i + length > len(path):
+                    break
+                segment = path[i:i + length]
+                before = path[i - 1] if i > 0 else None
+                after = path[i + length] if i + length < len(path) else None
+                removed = [edge for edge in ((before, segment[0]), (segment[-1], after)) if None not in edge]
+                added = [(before, after)] if before is not None and after is not None else []
+                best = None
+                for neighbor in set(G[segment[0]]) | set(G[segment[-1]]):
+                    k = positions[neighbor]
+                    if i <= k < i + length:
+                        continue
+                    # Gaps next to the neighbor once the segment is removed, skipping the gap the segment is taken from
+                    predecessor = path[k - 1] if k > 0 else None
+                    successor = path[k + 1] if k + 1 < len(path) else None
+                    if predecessor == segment[-1]:
+                        predecessor = before
+                    if successor == segment[0]:
+                        successor = after
+                    for gap in ((predecessor, neighbor), (neighbor, successor)):
+                        if gap == (before, after):
+                            continue
+                        for oriented in (segment, segment[::-1]):
+                            gap_removed = [gap] if None not in gap else []
+                            gap_added = [edge for edge in ((gap[0], oriented[0]), (oriented[-1], gap[1])) if None not in edge]
+                            weight_delta, jump_delta = _delta(G, removed + gap_removed, added + gap_added)
+                            if _improves(weight_delta, jump_delta) and (best is None or (weight_delta, -jump_delta) > (best[0], -best[1])):
+                                best = (weight_delta, jump_delta, gap, oriented)
+                if best is not None:
+                    weight_delta, jump_delta, (gap_start, gap_end), oriented = best
+                    remaining = path[:i] + path[i + length:]
+                    insert_at = remaining.index(gap_end) if gap_start is None else remaining.index(gap_start) + 1
+                    path = remaining[:insert_at] + oriented + remaining[insert_at:]
+                    positions = {node: position for position, node in enumerate(path)}
+                    total_weight, total_jumps, moves, improved = total_weight + weight_delta, total_jumps + jump_delta, moves + 1, True
+                    break
+
+    count('refine moves', moves)
+    print(f'Refined path with {moves} moves to {total_jumps} jumps and a total transition weight of {total_weight} in {time.monotonic() - start_time:.1f} seconds.')
+    return path
+
+
 def export_graph(G: nx.Graph, export_path: str):
     """
     Export the graph to a csv file. This csv file can be imported into Cosmograph for visualization.
@@ -105,20 +654,43 @@ def export_graph(G: nx.Graph, export_path: str):
             writer.writerow([source, target, data["weight"]])
     
 
+def path_songs(df: pd.DataFrame, path: list) -> pd.DataFrame:
+    """
+    Return the songs of the calculated path in order along with their Track Identifier and Media Duration In Milliseconds.
+    """
+    path_df = pd.DataFrame(path, columns=['Song Name'])
+    # Only the first stream of every song is merged, instead of all of its streams
+    songs = df[['Song Name', 'Track Identifier', 'Media Duration In Milliseconds']].drop_duplicates(subset='Song Name')
+    return compact_streams(path_df.merge(songs, on='Song Name', how='left').drop_duplicates(subset='Song Name'))
+
+
 def export_path(df: pd.DataFrame, path: list, export_path: str):
     """
     Export the calculated path to a sqlite3 database while also retaining the Track Identifier and Media Duration In Milliseconds columns.
     """
     print(f'Exporting optimal path to {export_path}...')
-    path_df = pd.DataFrame(path, columns=['Song Name'])
-    merged_df = path_df.merge(df[['Song Name', 'Track Identifier', 'Media Duration In Milliseconds']], on='Song Name', how='left').drop_duplicates(subset='Song Name')
+    merged_df = path_songs(df, path)
     with sqlite3.connect(export_path) as conn:
         merged_df.to_sql('exported_path', conn, if_exists='replace', index=False)
 
 
 if __name__ == '__main__':
-    df = preprocess_data(df=pd.read_sql('SELECT * FROM crossreference', sqlite3.connect('identified_songs.sqlite3')))
-    G = graph_data(df=df)
+    with connect('identified_songs.sqlite3') as conn:
+        with stage('fold'):
+            # Only fold the new streams into the stored transitions instead of preprocessing all of them, the store is rebuilt automatically if earlier streams were deleted or changed
+            fold_transitions(conn=conn)
+        with stage('graph'):
+            # The songs played for less than the minimum playtime in total or only once are filtered when reading
+            G = graph_from_transitions(transitions=read_transitions(conn, minimum_playtime=pd.Timedelta(minutes=5))) # Pass half_life=pd.Timedelta(days=365) to prefer recently heard transitions
+            songs = read_song_totals(conn, minimum_playtime=pd.Timedelta(minutes=5))
+    # Use graph_data_csr and find_path_csr instead for a compact graph on very long listening histories, see csr_to_networkx to export it
     # export_graph(G=G, export_path='graph.csv') # Uncomment this line to export the graph as a csv file for visualization purposes in Cosmograph
-    path = find_path(G=G, start_node=random.choice(list(G.nodes())))
-    export_path(df=df, path=path, export_path='calculated_path.sqlite3')
+    with stage('walk'):
+        path = find_best_path(G=G, starts=os.cpu_count(), workers=os.cpu_count())
+        # path = stitch_paths(G=G, paths=find_partition_paths(G=G, method='louvain', workers=os.cpu_count())) # Uncomment this line to find the paths of the communities in parallel, each of these paths can also be exported as its own playlist
+    with stage('refine'):
+        path = refine_path(G=G, path=path, time_budget=60)
+    with stage('export'):
+        export_path(df=songs, path=path, export_path='calculated_path.sqlite3')
+    # Save the timings of the stages and the counters, the time spent searching the shortest paths for the jumps is counted within the walk
+    dump_metrics('calculate_optimal_path_metrics.json')
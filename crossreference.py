@@ -1,109 +1,257 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
 import os
 import pandas as pd
-import pickle
-import sqlite3
-
-
-def read_data(filename: str) -> pd.DataFrame:
-    """
-    Read the data from the csv file and return it as a DataFrame.
-    """
-    # Strip file extension
-    pickle_filename = os.path.splitext(filename)[0] + '.pkl'
-    # Check if pickle file exists
-    if os.path.exists(pickle_filename):
-        with open(pickle_filename, 'rb') as f:
-            return pickle.load(f)
-
-    try:
-        df = pd.read_csv(filename, on_bad_lines='error', encoding='utf-8', engine='python')
-    except pd.errors.EmptyDataError:
-        df = pd.DataFrame()
-    except (TypeError, ValueError):
-        df = pd.read_csv(filename, sep=';', on_bad_lines='warn', encoding='utf-8', engine='python')
-        
-    # Save DataFrame to pickle file
-    with open(pickle_filename, 'wb') as f:
-        pickle.dump(df, f)    
-        
-    return df
+from ingest import DAILY_TRACKS_COLUMNS, PLAY_ACTIVITY_COLUMNS, read_data
+from metrics import Progress, count, dump_metrics, stage
+from storage import compact_streams, connect, write_crossreference, write_watermark
+from text_index import SubstringIndex
+
 
-def crossreference(df1: pd.DataFrame, df2: pd.DataFrame) -> pd.DataFrame:
+def prepare_play_activity(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Crossreference the two DataFrames by matching the song name and the event timestamp.
+    Select the necessary columns of the Play Activity DataFrame and drop all streams with a missing timestamp or any null or zero values.
     """
-    # Convert datetime in df1 and make sure it is timezone-naive
-    df1['Event Start Timestamp'] = pd.to_datetime(df1['Event Start Timestamp'], format='ISO8601').dt.tz_localize(None)
+    # Convert the timestamps to the timezone-naive local time the hours of the Daily Tracks file are given in, using the offset to UTC if the file contains it
+    # and the local time written in the timestamp otherwise, as the timestamps can have different offsets
+    if 'UTC Offset In Seconds' in df.columns:
+        timestamps = pd.to_datetime(df['Event Start Timestamp'], format='ISO8601', utc=True).dt.tz_convert(None)
+        df['Event Start Timestamp'] = timestamps + pd.to_timedelta(df['UTC Offset In Seconds'].fillna(0).astype('int64'), unit='s')
+    else:
+        df['Event Start Timestamp'] = pd.to_datetime(df['Event Start Timestamp'].str.replace(r'(?<=\d)(Z|[+-]\d{2}:?\d{2})$', '', regex=True), format='ISO8601')
+
+    # Drop rows with null values in specified columns
+    df = df.dropna(subset=['Event Start Timestamp'])
+
+    # Select necessary columns
+    df = df.loc[:, ['Event Start Timestamp', 'Song Name', 'Play Duration Milliseconds', 'Media Duration In Milliseconds']]
+
+    # Drop all rows that contain any zero values
+    df.replace(0, pd.NA, inplace=True)
+    return compact_streams(df.dropna())
+
 
-    # Convert date and hours in df2 to datetime
-    df2['Date Played'] = pd.to_datetime(df2['Date Played'], format='%Y%m%d')
-    df2 = df2.assign(Hours=df2['Hours'].str.split(',')).explode('Hours')
-    df2['Hours'] = df2['Hours'].astype(int)
+def prepare_daily_tracks(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Explode the hours of the Play History Daily Tracks DataFrame into one row per hour played and add an 'Event Timestamp' column.
+    """
+    # Convert date and hours to datetime
+    df['Date Played'] = pd.to_datetime(df['Date Played'], format='%Y%m%d')
+    df = df.assign(Hours=df['Hours'].str.split(',')).explode('Hours')
+    df['Hours'] = df['Hours'].astype(int)
 
     # Create a datetime column and make sure it is timezone-naive
-    df2['Event Timestamp'] = pd.to_datetime(df2['Date Played']) + pd.to_timedelta(df2['Hours'], unit='h')
+    df['Event Timestamp'] = pd.to_datetime(df['Date Played']) + pd.to_timedelta(df['Hours'], unit='h')
 
-    # Drop rows with null values in specified columns
-    df1.dropna(subset=['Event Start Timestamp'], inplace=True)
-    df2.dropna(subset=['Event Timestamp', 'Track Description'], inplace=True)
+    # Drop rows with null values in specified columns and select necessary columns
+    df = df.dropna(subset=['Event Timestamp', 'Track Description'])
+    return df.loc[:, ['Event Timestamp', 'Track Description', 'Track Identifier']]
 
-    # Select necessary columns
-    df1 = df1.loc[:, ['Event Start Timestamp', 'Song Name', 'Play Duration Milliseconds', 'Media Duration In Milliseconds']]
-    df2 = df2.loc[:, ['Event Timestamp', 'Track Description', 'Track Identifier']]
-
-    # Drop all rows that contain any zero values in df1
-    df1.replace(0, pd.NA, inplace=True)
-    df1.dropna(inplace=True)
-
-    def find_closest_match(row: pd.Series, df: pd.DataFrame) -> pd.Series:
-        if pd.isna(row['Track Identifier']):
-            # Create a mask to filter df based on the condition
-            mask = (
-                df['Event Timestamp'].between(row['Event Start Timestamp'] - pd.Timedelta(hours=2), row['Event Start Timestamp'] + pd.Timedelta(hours=2)) &
-                df['Track Description'].str.contains(row['Song Name'], case=False, regex=False, na=False)
-            )
-            # Apply the mask to df
-            matches = df[mask]
-
-            # If there are any matches
-            if not matches.empty:
-                # Find the closest match based on the 'Event Timestamp'
-                closest_match = matches[abs(matches['Event Timestamp'] - row['Event Start Timestamp']) == abs(matches['Event Timestamp'] - row['Event Start Timestamp']).min()].iloc[0]
-                # Update the row with the details of the closest match
-                row['Song Name'] = closest_match['Track Description']
-                row['Track Identifier'] = closest_match['Track Identifier']
-                print(f'Matched {row["Song Name"]} ({row["Event Start Timestamp"]}) based on time')
-        
-        return row
-
-    # Apply the find_closest_match function to the df1 DataFrame
-    matched_songs = df1.apply(find_closest_match, axis=1, df=df2)
-
-    def rematch_based_on_length(row: pd.Series, df: pd.DataFrame) -> pd.Series:
-        """
-        Rematch songs based on the song name and the media duration in milliseconds.
-        """
-        # If the 'Track Identifier' is NaN
-        if pd.isna(row['Track Identifier']):
-            # Find matches based on 'Song Name' and 'Media Duration In Milliseconds'
-            matches = df[(df['Song Name'].str.contains(row['Song Name'], regex=False, case=False)) & (df['Media Duration In Milliseconds'] == row['Media Duration In Milliseconds']) & (~pd.isna(df['Track Identifier']))]
-            # If there are any matches
-            if not matches.empty:
-                # Update the row with the details of the first match
-                row['Track Identifier'] = matches.iloc[0]['Track Identifier']
-                row['Song Name'] = matches.iloc[0]['Song Name']
-                print(f'Rematched {row["Song Name"]} ({row["Event Start Timestamp"]}) based on length')
-        
-        return row
-
-    # Apply the rematch_based_on_length function to the 'matched_songs' DataFrame
-    matched_songs = matched_songs.apply(rematch_based_on_length, axis=1, df=matched_songs)
+
+def assign_values(df: pd.DataFrame, rows: np.ndarray, column: str, values: np.ndarray):
+    """
+    Assign the values to the column at the row positions, adding the values which are not yet a category of a categorical column first.
+    """
+    if isinstance(df[column].dtype, pd.CategoricalDtype):
+        df[column] = df[column].cat.add_categories(pd.Index(pd.unique(values)).difference(df[column].cat.categories).dropna())
+    df.iloc[rows, df.columns.get_loc(column)] = values
+
+
+def find_closest_matches(df1: pd.DataFrame, df2: pd.DataFrame, window: pd.Timedelta = pd.Timedelta(hours=2), chunk_size: int = 100_000) -> pd.DataFrame:
+    """
+    Match all songs without a Track Identifier to the closest Track Description within the time window that contains their Song Name.
+    Both sides are sorted by timestamp so that only the candidates within the window are compared, ties are resolved by the order of df2.
+    """
+    df1 = df1.copy()
+    if 'Track Identifier' not in df1.columns:
+        df1['Track Identifier'] = pd.Series(pd.NA, index=df1.index, dtype='Int64')
+
+    # Sort the daily tracks by timestamp, keeping their original order for equal timestamps
+    event_timestamps = df2['Event Timestamp'].to_numpy(dtype='datetime64[ns]').view('int64')
+    order = np.argsort(event_timestamps, kind='stable')
+    sorted_timestamps = event_timestamps[order]
+    descriptions = df2['Track Description'].to_numpy(dtype=object)
+    identifiers = pd.array(df2['Track Identifier'], dtype='Int64')
+    description_index = SubstringIndex(descriptions)
+
+    # Find the range of candidates within the time window for every unmatched song
+    pending = np.flatnonzero(df1['Track Identifier'].isna().to_numpy())
+    start_timestamps = df1['Event Start Timestamp'].to_numpy(dtype='datetime64[ns]').view('int64')[pending]
+    lower = np.searchsorted(sorted_timestamps, start_timestamps - window.value, side='left')
+    upper = np.searchsorted(sorted_timestamps, start_timestamps + window.value, side='right')
+    name_codes, unique_names = pd.factorize(df1['Song Name'].to_numpy(dtype=object)[pending])
+
+    # Look up which track descriptions contain each distinct song name
+    value_count = len(description_index.texts)
+    contained = np.concatenate([np.zeros(0, dtype=np.int64)] + [
+        name_code * value_count + description_index.matching_values(name)
+        for name_code, name in enumerate(unique_names) if isinstance(name, str)
+    ])
+
+    match_rows, match_candidates = [], []
+    progress = Progress('Matching songs based on time', total=len(pending))
+    for chunk_start in range(0, len(pending), chunk_size):
+        chunk_lower, chunk_upper = lower[chunk_start:chunk_start + chunk_size], upper[chunk_start:chunk_start + chunk_size]
+        counts = chunk_upper - chunk_lower
+
+        # Expand the ranges into (song, candidate) pairs
+        rows = np.repeat(np.arange(chunk_start, chunk_start + len(counts)), counts)
+        offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = order[lower[rows] + offsets]
+
+        # Only keep the candidates whose Track Description contains the Song Name
+        description_codes = description_index.codes[candidates]
+        mask = (description_codes >= 0) & np.isin(name_codes[rows].astype(np.int64) * value_count + description_codes, contained)
+        rows, candidates = rows[mask], candidates[mask]
+
+        # Find the closest match based on the 'Event Timestamp', the first one in df2 in case of a tie
+        distances = np.abs(event_timestamps[candidates] - start_timestamps[rows])
+        ranking = np.lexsort((candidates, distances, rows))
+        rows, candidates = rows[ranking], candidates[ranking]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = rows[1:] != rows[:-1]
+        match_rows.append(rows[first])
+        match_candidates.append(candidates[first])
+        progress.update(len(counts))
+
+    # Update the songs with the details of their closest match
+    if match_rows:
+        rows, candidates = pending[np.concatenate(match_rows)], np.concatenate(match_candidates)
+        assign_values(df1, rows, 'Song Name', descriptions[candidates])
+        assign_values(df1, rows, 'Track Identifier', identifiers[candidates])
+        print(f'Matched {len(rows)} songs based on time')
+
+    return df1
+
+
+def remove_unused_categories(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Remove the unused categories of all categorical columns.
+    """
+    return df.assign(**{column: df[column].cat.remove_unused_categories() for column in df.select_dtypes('category').columns})
+
+
+def find_closest_matches_parallel(df1: pd.DataFrame, df2: pd.DataFrame, workers: int, window: pd.Timedelta = pd.Timedelta(hours=2), freq: str = 'M') -> pd.DataFrame:
+    """
+    Match the songs like find_closest_matches, but split df1 into time shards which are matched in a pool of worker processes.
+    Every shard is sent along with the slice of df2 within the time window around it, so the results are the same as the serial ones.
+    """
+    df1 = df1.copy()
+    if 'Track Identifier' not in df1.columns:
+        df1['Track Identifier'] = pd.Series(pd.NA, index=df1.index, dtype='Int64')
+
+    # Split the unmatched songs into shards by their period
+    pending = np.flatnonzero(df1['Track Identifier'].isna().to_numpy())
+    start_timestamps = df1['Event Start Timestamp'].iloc[pending]
+    shards = [pending[rows] for _, rows in sorted(start_timestamps.groupby(start_timestamps.dt.to_period(freq).to_numpy()).indices.items())]
+
+    # Slice df2 to each shard's time range widened by the window, keeping its order for the tie-break
+    # Categorical columns only keep the categories used by the shard, so not every shard has to carry all names to its worker
+    columns = ['Event Start Timestamp', 'Song Name', 'Track Identifier']
+    shards_df1 = [remove_unused_categories(df1.iloc[rows][columns]) for rows in shards]
+    shards_df2 = [remove_unused_categories(df2[df2['Event Timestamp'].between(shard['Event Start Timestamp'].min() - window, shard['Event Start Timestamp'].max() + window)]) for shard in shards_df1]
+
+    # Match the shards in parallel and merge the results in shard order
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for rows, matched in zip(shards, executor.map(find_closest_matches, shards_df1, shards_df2, repeat(window))):
+            for column in ('Song Name', 'Track Identifier'):
+                assign_values(df1, rows, column, matched[column].to_numpy())
+
+    return df1
+
+
+def rematch_based_on_length(df: pd.DataFrame, tolerance: int = 0) -> pd.DataFrame:
+    """
+    Rematch songs without a Track Identifier to the first identified song whose Song Name contains theirs and whose media duration differs by at most the tolerance in milliseconds.
+    The identified songs are bucketed by media duration, so only the neighbouring buckets have to be searched for every distinct unmatched song.
+    """
+    df = df.copy()
+    names = df['Song Name'].to_numpy(dtype=object)
+    durations = pd.to_numeric(df['Media Duration In Milliseconds'], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    identified = df['Track Identifier'].notna().to_numpy()
+
+    # Only the first identified song of every song name and media duration can be a match
+    candidates = np.flatnonzero(identified & ~np.isnan(durations))
+    candidates = candidates[~pd.DataFrame({'Song Name': names[candidates], 'Duration': durations[candidates]}).duplicated().to_numpy()]
+    name_index = SubstringIndex(names[candidates])
+
+    # Group the candidates by media duration bucket, buckets are wide enough that matches are at most one bucket apart
+    bucket_width = tolerance + 1
+    buckets = pd.Series(np.arange(len(candidates))).groupby(np.floor(durations[candidates] / bucket_width)).apply(np.array).to_dict()
+
+    # Resolve every distinct unmatched song name and media duration once
+    unmatched = pd.DataFrame({'Song Name': names, 'Duration': durations})[~identified & ~np.isnan(durations)]
+    # Build the mask as a boolean array, as mapping an empty column returns an object Series which would select columns instead of rows
+    unmatched = unmatched[np.array([isinstance(name, str) for name in unmatched['Song Name']], dtype=bool)]
+    rows, matches = [], []
+    for (name, duration), group in unmatched.groupby(['Song Name', 'Duration'], sort=False).indices.items():
+        bucket = np.floor(duration / bucket_width)
+        neighbours = [buckets[key] for key in (bucket - 1, bucket, bucket + 1) if key in buckets]
+        if not neighbours:
+            continue
+        neighbours = np.concatenate(neighbours)
+        neighbours = neighbours[np.abs(durations[candidates[neighbours]] - duration) <= tolerance]
+        neighbours = neighbours[np.isin(name_index.codes[neighbours], name_index.matching_values(name))]
+        if len(neighbours):
+            rows.append(unmatched.index.to_numpy()[group])
+            matches.append(np.full(len(group), candidates[neighbours].min()))
+
+    # Update the songs with the details of the first match
+    if rows:
+        rows, matches = np.concatenate(rows), np.concatenate(matches)
+        for column in ('Track Identifier', 'Song Name'):
+            assign_values(df, rows, column, df[column].array[matches])
+        print(f'Rematched {len(rows)} songs based on length')
+
+    return df
+
+
+def match_streams(df1: pd.DataFrame, df2: pd.DataFrame, workers: int = 1, window: pd.Timedelta = pd.Timedelta(hours=2)) -> pd.DataFrame:
+    """
+    Prepare the two DataFrames and match the songs in df1 to their closest track in df2, using multiple processes if more than one worker is given.
+    """
+    df1 = prepare_play_activity(df1)
+    df2 = prepare_daily_tracks(df2)
+
+    # Match all songs in df1 to their closest track in df2
+    matched_songs = find_closest_matches(df1, df2, window) if workers <= 1 else find_closest_matches_parallel(df1, df2, workers, window)
+    count('streams', len(matched_songs))
+    count('time matches', matched_songs['Track Identifier'].notna().sum())
+    return matched_songs
+
+
+def rematch_streams(matched_songs: pd.DataFrame, tolerance: int = 0) -> pd.DataFrame:
+    """
+    Rematch the songs which could not be matched based on time based on their length and return them with the compact dtypes sorted by 'Event Start Timestamp'.
+    """
+    identified_count = matched_songs['Track Identifier'].notna().sum()
+    matched_songs = rematch_based_on_length(matched_songs, tolerance)
+    count('length rematches', matched_songs['Track Identifier'].notna().sum() - identified_count)
+    count('unmatched streams', matched_songs['Track Identifier'].isna().sum())
     print(f'Number of matches: {matched_songs["Track Identifier"].notna().sum()}, Number of unmatched songs: {matched_songs["Track Identifier"].isna().sum()}')
-    # Return the 'matched_songs' DataFrame sorted by 'Event Start Timestamp'
-    return matched_songs.sort_values(by='Event Start Timestamp')
+    return compact_streams(matched_songs).sort_values(by='Event Start Timestamp')
+
+
+def crossreference(df1: pd.DataFrame, df2: pd.DataFrame, workers: int = 1) -> pd.DataFrame:
+    """
+    Crossreference the two DataFrames by matching the song name and the event timestamp, using multiple processes if more than one worker is given.
+    """
+    with stage('crossreference'):
+        matched_songs = match_streams(df1, df2, workers)
+
+    # Rematch the remaining songs based on their length
+    with stage('rematch'):
+        return rematch_streams(matched_songs)
 
 if __name__ == '__main__':
-    play_activity_path = read_data(r'<your_play_activity_path>')
-    play_history_daily_path = read_data(r'<your_play_history_daily_path>')
+    with stage('ingest'):
+        play_activity_path = read_data(r'<your_play_activity_path>', columns=PLAY_ACTIVITY_COLUMNS)
+        play_history_daily_path = read_data(r'<your_play_history_daily_path>', columns=DAILY_TRACKS_COLUMNS)
+    matched_songs = crossreference(play_activity_path, play_history_daily_path, workers=os.cpu_count())
     # Save the 'crossreference' DataFrame to a sqlite3 database
-    crossreference(play_activity_path, play_history_daily_path).to_sql('crossreference', sqlite3.connect('identified_songs.sqlite3'), if_exists='replace', index=False)
+    with stage('store'), connect() as conn:
+        write_crossreference(conn, matched_songs, replace=True)
+        write_watermark(conn, matched_songs['Event Start Timestamp'].max())
+    # Save the timings of the stages and the counters, use a .csv path for a csv file instead
+    dump_metrics('crossreference_metrics.json')
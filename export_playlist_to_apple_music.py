@@ -1,16 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 from dotenv import load_dotenv
+from email.utils import parsedate_to_datetime
 import json
+from metrics import Progress, count, dump_metrics, stage
 import os
 import pandas as pd
+import random
 import sqlite3
+from storage import connect, read_catalog, write_catalog
+import time
 import urllib3
 
 
 load_dotenv()
 
 CALCULALTED_SONGS = 'calculated_path.sqlite3'
-HOST = 'https://amp-api.music.apple.com'
+HOST = os.environ.get('APPLE_MUSIC_HOST', 'https://amp-api.music.apple.com')
 COUNTRY_CODE = 'de'
 HEADERS = {
     'Media-User-Token': os.environ.get('MEDIA_USER_TOKEN'),
@@ -21,65 +27,323 @@ HEADERS = {
     'Accept-Encoding': 'gzip, deflate'
 }
 
+# Responses which are retried after backing off, a 500 means that a song is not available in the catalog instead
+RETRY_STATUSES = (429, 502, 503, 504)
 
-def get_songs():
+
+def get_songs(filename: str = CALCULALTED_SONGS):
     """
     Get the songs from the database and return them as a list of integers.
     """
-    conn = sqlite3.connect(CALCULALTED_SONGS)
+    conn = sqlite3.connect(filename)
     df = pd.read_sql('SELECT * FROM exported_path', conn)
     return df['Track Identifier'].astype(int).tolist()
-    
 
-def get_playlist_id_and_add_songs(song_ids: list) -> str:
+
+class Backoff:
+    """
+    Adaptive delay between the requests, which doubles whenever the API throttles or fails temporarily and halves again with every successful request.
+    A Retry-After header sent by the API takes precedence if it asks for a longer delay.
+    """
+    def __init__(self, initial: float = 0.5, maximum: float = 60):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = 0
+
+    def wait(self):
+        """
+        Wait for the current delay before sending the next request.
+        """
+        if self.delay:
+            time.sleep(self.delay)
+
+    def success(self):
+        """
+        Shorten the delay after a successful request.
+        """
+        self.delay = self.delay / 2 if self.delay >= self.initial else 0
+
+    def failure(self, retry_after: str = None):
+        """
+        Lengthen the delay after a throttled or failed request, at least to the value of the Retry-After header.
+        """
+        self.delay = min(max(self.delay * 2, self.initial), self.maximum) * random.uniform(1, 1.25)
+        self.delay = max(self.delay, parse_retry_after(retry_after))
+
+
+def parse_retry_after(value: str) -> float:
+    """
+    Return the number of seconds to wait from a Retry-After header, which is either given in seconds or as an HTTP date.
+    """
+    if not value:
+        return 0
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        try:
+            return max((parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            return 0
+
+
+def request(http: urllib3.PoolManager, backoff: Backoff, method: str, url: str, body: str = None, max_retries: int = 8, idempotent: bool = True) -> urllib3.HTTPResponse:
+    """
+    Send the request, retrying it with an adaptive backoff while it is throttled, fails temporarily or the connection fails.
+    Requests which are not idempotent are only retried if they were throttled or the connection failed before they were sent, as the API may have
+    processed them otherwise. The response of a temporary failure is returned and other connection errors are raised instead.
+    """
+    retry_statuses = RETRY_STATUSES if idempotent else (429,)
+    for attempt in range(max_retries + 1):
+        backoff.wait()
+        try:
+            response = http.request(method, url, headers=HEADERS, body=body, retries=False)
+        except urllib3.exceptions.HTTPError as error:
+            count('api connection errors')
+            # A failed connection attempt, which includes failed name resolutions, means that the request has not been sent
+            if attempt == max_retries or not (idempotent or isinstance(error, urllib3.exceptions.ConnectTimeoutError)):
+                raise
+            backoff.failure()
+            print(f'Error {error} - Retrying in {backoff.delay:.1f} seconds...')
+            continue
+
+        count(f'api status {response.status}')
+        if response.status not in retry_statuses or attempt == max_retries:
+            backoff.success()
+            return response
+        backoff.failure(response.headers.get('Retry-After'))
+        print(f'Error {response.status} - Retrying in {backoff.delay:.1f} seconds...')
+
+
+def create_playlist(http: urllib3.PoolManager, backoff: Backoff, host: str = HOST, max_retries: int = 8) -> str:
+    """
+    Create a new Apple Music playlist and return its id.
+    Creating a playlist is not idempotent, so after a failure which may have happened after the API created it, the playlists are searched for
+    its name and the request is only sent again if the playlist does not exist yet.
+    """
+    name = f'Sorted Songs ({datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")})'
+    playlist_body = json.dumps({'attributes': {'name': name}})
+    for attempt in range(max_retries + 1):
+        try:
+            playlist_response = request(http, backoff, 'POST', f'{host}/v1/me/library/playlists', body=playlist_body, idempotent=False)
+            if playlist_response.status in (200, 201):
+                return json.loads(playlist_response.data)['data'][0]['id']
+            if playlist_response.status not in RETRY_STATUSES or attempt == max_retries:
+                raise RuntimeError(f'Could not create playlist {name}: {playlist_response.status} - {playlist_response.data.decode("utf-8")}')
+            backoff.failure(playlist_response.headers.get('Retry-After'))
+            print(f'Error {playlist_response.status} - Checking for playlist {name} before retrying in {backoff.delay:.1f} seconds...')
+        except urllib3.exceptions.HTTPError as error:
+            if attempt == max_retries:
+                raise
+            backoff.failure()
+            print(f'Error {error} - Checking for playlist {name} before retrying in {backoff.delay:.1f} seconds...')
+
+        # The name contains the time of the run, so a playlist with it can only have been created by the failed request
+        count('playlist checks')
+        playlist_id = find_playlist(http, backoff, name, host)
+        if playlist_id is not None:
+            return playlist_id
+
+
+def find_playlist(http: urllib3.PoolManager, backoff: Backoff, name: str, host: str = HOST) -> str:
+    """
+    Return the id of the library playlist with the given name, or None if there is none, following the pages of the response.
+    """
+    url = f'{host}/v1/me/library/playlists?limit=100'
+    while url:
+        response = request(http, backoff, 'GET', url)
+        # The API answers with a 404 if the library has no playlists yet
+        if response.status == 404:
+            break
+        if response.status != 200:
+            raise RuntimeError(f'Could not read the library playlists: {response.status} - {response.data.decode("utf-8")}')
+        page = json.loads(response.data)
+        for playlist in page.get('data', []):
+            if playlist.get('attributes', {}).get('name') == name:
+                return playlist['id']
+        url = f'{host}{page["next"]}' if page.get('next') else None
+    return None
+
+
+def find_equivalent_song(http: urllib3.PoolManager, backoff: Backoff, song_id: int, host: str = HOST) -> str:
+    """
+    Return the id of an equivalent song in the selected catalog, or None if there is none.
+    """
+    return lookup_equivalent_song(http, backoff, song_id, host)[1]
+
+
+def lookup_equivalent_song(http: urllib3.PoolManager, backoff: Backoff, song_id: int, host: str = HOST) -> tuple:
+    """
+    Look up an equivalent song in the selected catalog and return whether the lookup succeeded along with the id of the equivalent song, or None if there is none.
+    """
+    response = request(http, backoff, 'GET', f'{host}/v1/catalog/{COUNTRY_CODE}/songs?filter[equivalents]={song_id}')
+    if response.status != 200:
+        return False, None
+    try:
+        return True, json.loads(response.data)['data'][0]['id']
+    except (KeyError, IndexError):
+        return True, None
+
+
+def check_availability(http: urllib3.PoolManager, backoff: Backoff, song_ids: list, host: str = HOST, batch_size: int = 300) -> tuple:
+    """
+    Check which songs are available in the selected catalog with one request for every batch of ids and return the available and unavailable ids.
+    Songs of batches whose request failed are in neither of them.
+    """
+    available, unavailable = set(), set()
+    for batch_start in range(0, len(song_ids), batch_size):
+        batch = song_ids[batch_start:batch_start + batch_size]
+        response = request(http, backoff, 'GET', f'{host}/v1/catalog/{COUNTRY_CODE}/songs?ids={",".join(str(song_id) for song_id in batch)}')
+        if response.status not in (200, 404):
+            print(f'ERROR {response.status} - {response.data.decode("utf-8")}')
+            continue
+        found = {song['id'] for song in json.loads(response.data).get('data', [])} if response.status == 200 else set()
+        available.update(song_id for song_id in batch if str(song_id) in found)
+        unavailable.update(song_id for song_id in batch if str(song_id) not in found)
+    return available, unavailable
+
+
+def resolve_songs(conn: sqlite3.Connection, song_ids: list, host: str = HOST, ttl: pd.Timedelta = pd.Timedelta(days=30), workers: int = 8) -> list:
+    """
+    Resolve the songs to their ids in the selected catalog before the playlist is created, replacing unavailable songs by an equivalent song and dropping them if there is none.
+    The results are cached per storefront for the ttl, so only the songs which have not been checked recently are looked up in the catalog.
+    """
+    now = pd.Timestamp.now()
+    catalog_ids = read_catalog(conn, COUNTRY_CODE, now - ttl)
+    pending = list(dict.fromkeys(song_id for song_id in song_ids if song_id not in catalog_ids))
+    count('catalog cache hits', len(set(song_ids)) - len(pending))
+    print(f'Checking {len(pending)} of {len(set(song_ids))} songs in the {COUNTRY_CODE} catalog, the others are cached...')
+
+    # Check the availability of the songs in batches, then look up the equivalents of the unavailable ones concurrently as their order does not matter
+    http = urllib3.PoolManager(maxsize=workers, block=True)
+    backoff = Backoff()
+    available, unavailable = check_availability(http, backoff, pending, host)
+    resolved = {song_id: str(song_id) for song_id in available}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for song_id, (found, equivalent_song_id) in zip(unavailable, executor.map(lambda song_id: lookup_equivalent_song(http, backoff, song_id, host), unavailable)):
+            if found:
+                resolved[song_id] = equivalent_song_id
+    write_catalog(conn, COUNTRY_CODE, resolved, now)
+    catalog_ids.update(resolved)
+
+    # Keep the songs whose check failed as they are, the upload still handles them if they turn out to be unavailable
+    missing = [song_id for song_id in song_ids if song_id in catalog_ids and catalog_ids[song_id] is None]
+    if missing:
+        print(f'IMPORTANT: No equivalent songs found for {len(missing)} songs: {missing}')
+    return [catalog_ids.get(song_id, str(song_id)) for song_id in song_ids if song_id not in catalog_ids or catalog_ids[song_id] is not None]
+
+
+def playlist_tracks(http: urllib3.PoolManager, backoff: Backoff, playlist_id: str, host: str = HOST) -> list:
+    """
+    Return the catalog ids of the tracks of the playlist in order, following the pages of the response.
+    """
+    catalog_ids = []
+    url = f'{host}/v1/me/library/playlists/{playlist_id}/tracks?limit=100'
+    while url:
+        response = request(http, backoff, 'GET', url)
+        # The API answers with a 404 if the playlist has no tracks yet
+        if response.status == 404:
+            break
+        if response.status != 200:
+            raise RuntimeError(f'Could not read the tracks of playlist {playlist_id}: {response.status} - {response.data.decode("utf-8")}')
+        page = json.loads(response.data)
+        catalog_ids += [str(track.get('attributes', {}).get('playParams', {}).get('catalogId', track['id'])) for track in page.get('data', [])]
+        url = f'{host}{page["next"]}' if page.get('next') else None
+    return catalog_ids
+
+
+def append_tracks(http: urllib3.PoolManager, backoff: Backoff, playlist_id: str, song_ids: list, host: str = HOST, max_retries: int = 8) -> tuple:
     """
-    Create a new Apple Music playlist and add the songs to it, if possible.
+    Append the songs to the playlist and return the status of the request along with its response body.
+    Adding tracks is not idempotent, so after a failure which may have happened after the API appended them, the tracks of the playlist are read
+    back and the request is only sent again if the songs are not at the end of the playlist yet.
     """
-    def add_song_to_playlist(http: urllib3.PoolManager, playlist_id: str, song_id: int) -> urllib3.HTTPResponse:
-        body = json.dumps({
-            'data': [{'id': song_id, 'type': 'songs'}]
-        })
-        response = http.request('POST', f'{HOST}/v1/me/library/playlists/{playlist_id}/tracks', headers=HEADERS, body=body)
+    url = f'{host}/v1/me/library/playlists/{playlist_id}/tracks'
+    body = json.dumps({'data': [{'id': str(song_id), 'type': 'songs'} for song_id in song_ids]})
+    for attempt in range(max_retries + 1):
+        try:
+            response = request(http, backoff, 'POST', url, body=body, idempotent=False)
+            if response.status not in RETRY_STATUSES or attempt == max_retries:
+                return response.status, response.data.decode('utf-8')
+            backoff.failure(response.headers.get('Retry-After'))
+            print(f'Error {response.status} - Checking playlist {playlist_id} before retrying in {backoff.delay:.1f} seconds...')
+        except urllib3.exceptions.HTTPError as error:
+            if attempt == max_retries:
+                raise
+            backoff.failure()
+            print(f'Error {error} - Checking playlist {playlist_id} before retrying in {backoff.delay:.1f} seconds...')
+
+        # The songs of the path are unique, so they are only at the end of the playlist if the failed request appended them
+        count('playlist checks')
+        if playlist_tracks(http, backoff, playlist_id, host)[-len(song_ids):] == [str(song_id) for song_id in song_ids]:
+            return 204, ''
 
-        return response
 
-    http = urllib3.PoolManager()
+def add_songs(http: urllib3.PoolManager, backoff: Backoff, playlist_id: str, song_ids: list, host: str = HOST) -> list:
+    """
+    Add the songs to the playlist in a single request, splitting the batch in halves whenever it contains a song which is not available in the catalog.
+    Songs which are not available on their own are replaced by an equivalent song if possible, the ids of the songs which could not be added are returned.
+    The halves are added one after another, so the songs end up in the playlist in the given order.
+    """
+    status, message = append_tracks(http, backoff, playlist_id, song_ids, host)
+    if status in (200, 201, 204):
+        return []
+    if status != 500:
+        print(f'ERROR {status} - {message}')
+        return list(song_ids)
+
+    if len(song_ids) > 1:
+        middle = len(song_ids) // 2
+        return add_songs(http, backoff, playlist_id, song_ids[:middle], host) + add_songs(http, backoff, playlist_id, song_ids[middle:], host)
+
+    # If the song is not available in the selected catalog, try to find an equivalent song
+    count('equivalent lookups')
+    equivalent_song_id = find_equivalent_song(http, backoff, song_ids[0], host)
+    if equivalent_song_id is None:
+        print(f'IMPORTANT: Error - No equivalent song found for {song_ids[0]}')
+        return list(song_ids)
+    status, message = append_tracks(http, backoff, playlist_id, [equivalent_song_id], host)
+    if status not in (200, 201, 204):
+        print(f'ERROR {status} - {message}')
+        return list(song_ids)
+    count('equivalents added')
+    return []
+
+
+def get_playlist_id_and_add_songs(song_ids: list, batch_size: int = 100, host: str = HOST) -> str:
+    """
+    Create a new Apple Music playlist and add the songs to it in batches, if possible.
+    The batches are sent one after another over a single pooled connection, as the API appends the tracks in the order the requests arrive.
+    """
+    http = urllib3.PoolManager(maxsize=1, block=True)
+    backoff = Backoff()
 
     # Create a new playlist
-    playlist_body = json.dumps({
-        'attributes': {
-            'name': f'Sorted Songs ({datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")})'
-        }
-    })
-    playlist_response = http.request('POST', f'{HOST}/v1/me/library/playlists', headers=HEADERS, body=playlist_body)
-    playlist_id = json.loads(playlist_response.data)['data'][0]['id']
+    playlist_id = create_playlist(http, backoff, host)
     print(f'Playlist created with ID: {playlist_id}')
 
     # Add songs to the playlist
-    for song_id in song_ids:
-        print(f'Adding song {song_id} to playlist {playlist_id}...')
-        response = add_song_to_playlist(http, playlist_id, song_id)
-        if response.status == 500:
-            # If the song is not available in the selected catalog, try to find an equivalent song
-            print(f'Error {response.status} - Fetching equivalent song...')
-            equiv_response = http.request('GET', f'{HOST}/v1/catalog/{COUNTRY_CODE}/songs?filter[equivalents]={song_id}', headers=HEADERS)
-            if equiv_response.status == 200:
-                try:
-                    equivalent_song_id = json.loads(equiv_response.data)['data'][0]['id']
-                except (KeyError, IndexError):
-                    print(f'IMPORTANT: Error - No equivalent song found for {song_id}')
-                else:
-                    print(f'Adding equivalent song id {equivalent_song_id} for {song_id} to the playlist...')
-                    response = add_song_to_playlist(http, playlist_id, equivalent_song_id)
-            if response.status not in (200, 204):
-                print(f'ERROR {response.status} - {response.data.decode("utf-8")}')
-        elif response.status not in (200, 204):
-            print(f'ERROR {response.status} - {response.data.decode("utf-8")}')
+    failed_song_ids = []
+    progress = Progress(f'Adding songs to playlist {playlist_id}', total=len(song_ids))
+    for batch_start in range(0, len(song_ids), batch_size):
+        batch = song_ids[batch_start:batch_start + batch_size]
+        failed_song_ids += add_songs(http, backoff, playlist_id, batch, host)
+        progress.update(len(batch))
 
+    count('songs added', len(song_ids) - len(failed_song_ids))
+    count('songs failed', len(failed_song_ids))
+    if failed_song_ids:
+        print(f'IMPORTANT: {len(failed_song_ids)} songs could not be added: {failed_song_ids}')
     return playlist_id
 
 
 if __name__ == '__main__':
-    song_ids = get_songs()
-    playlist_id = get_playlist_id_and_add_songs(song_ids)
+    with stage('ingest'):
+        song_ids = get_songs()
+    # Resolve the songs in the catalog first, so that unavailable songs do not make the adds fail
+    with stage('preflight'), connect() as conn:
+        song_ids = resolve_songs(conn, song_ids)
+    with stage('export'):
+        playlist_id = get_playlist_id_and_add_songs(song_ids)
     print(f'Songs successfully added to playlist "{playlist_id}".')
+    # Save the timings of the stages and the counters of the API statuses, use a .csv path for a csv file instead
+    dump_metrics('export_metrics.json')
@@ -0,0 +1,111 @@
+import csv
+import hashlib
+import json
+import os
+import pandas as pd
+
+
+# Columns needed from the Apple Music Play Activity file and their dtypes, the repeating names are read as categories
+# The offset to UTC is only used for the local time of the timestamps and skipped if the file does not contain it
+PLAY_ACTIVITY_COLUMNS = {
+    'Event Start Timestamp': str,
+    'Song Name': 'category',
+    'Play Duration Milliseconds': 'Int32',
+    'Media Duration In Milliseconds': 'Int32',
+    'UTC Offset In Seconds': 'Int32',
+}
+
+# Columns needed from the Apple Music - Play History Daily Tracks file and their dtypes
+DAILY_TRACKS_COLUMNS = {
+    'Date Played': str,
+    'Hours': str,
+    'Track Description': 'category',
+    'Track Identifier': 'Int64',
+}
+
+
+def sniff_delimiter(filename: str, sample_size: int = 65536) -> str:
+    """
+    Guess the delimiter of the csv file from its first bytes, defaulting to a comma.
+    """
+    with open(filename, 'r', encoding='utf-8', errors='replace', newline='') as f:
+        sample = f.read(sample_size)
+    try:
+        return csv.Sniffer().sniff(sample.split('\n', 1)[0], delimiters=',;\t').delimiter
+    except csv.Error:
+        return ','
+
+
+def file_hash(filename: str, block_size: int = 1 << 20) -> str:
+    """
+    Calculate the hash of the content of the file.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_data(filename: str, columns: dict = None) -> pd.DataFrame:
+    """
+    Read the columns from the csv file and return them as a DataFrame with the given dtypes, all columns are read if none are given.
+    The DataFrame is cached next to the csv file in the Feather format and only re-read if the size, modification time and content of the file changed.
+    """
+    # Every selection of columns has its own cache file
+    selection = hashlib.blake2b(json.dumps({name: str(dtype) for name, dtype in (columns or {}).items()}).encode(), digest_size=4).hexdigest()
+    cache_filename = f'{os.path.splitext(filename)[0]}.{selection}.feather'
+    metadata_filename = cache_filename + '.json'
+
+    # Reuse the cache if the file is unchanged, only hashing its content if the size matches but the modification time does not
+    stat = os.stat(filename)
+    metadata = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if os.path.exists(cache_filename) and os.path.exists(metadata_filename):
+        with open(metadata_filename, 'r', encoding='utf-8') as f:
+            cached_metadata = json.load(f)
+        if cached_metadata['size'] == metadata['size']:
+            if cached_metadata['mtime_ns'] == metadata['mtime_ns']:
+                return pd.read_feather(cache_filename)
+            metadata['hash'] = file_hash(filename)
+            if cached_metadata['hash'] == metadata['hash']:
+                with open(metadata_filename, 'w', encoding='utf-8') as f:
+                    json.dump(metadata, f)
+                return pd.read_feather(cache_filename)
+
+    try:
+        df = pd.read_csv(
+            filename,
+            sep=sniff_delimiter(filename),
+            usecols=(lambda name: name in columns) if columns else None,
+            dtype=columns,
+            on_bad_lines='warn',
+            encoding='utf-8',
+            engine='c',
+        )
+    except pd.errors.EmptyDataError:
+        df = pd.DataFrame()
+
+    # Save the DataFrame to the cache along with the metadata of the file
+    metadata.setdefault('hash', file_hash(filename))
+    df.reset_index(drop=True).to_feather(cache_filename)
+    with open(metadata_filename, 'w', encoding='utf-8') as f:
+        json.dump(metadata, f)
+
+    return df
+
+
+def read_chunks(filename: str, columns: dict, chunk_size: int = 1_000_000):
+    """
+    Read the columns from the csv file in chunks of rows with the given dtypes, columns which are missing from the file are left out.
+    Unlike read_data nothing is cached, so the file never has to fit into memory as a whole.
+    """
+    yield from pd.read_csv(
+        filename,
+        sep=sniff_delimiter(filename),
+        usecols=lambda name: name in columns,
+        dtype=columns,
+        on_bad_lines='warn',
+        encoding='utf-8',
+        engine='c',
+        chunksize=chunk_size,
+    )
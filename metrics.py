@@ -0,0 +1,123 @@
+from contextlib import contextmanager
+import csv
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # The resource module is not available on Windows, where the peak memory is not recorded
+    resource = None
+
+
+# Timings of the stages in the order they finished and the counters of this process
+STAGES = []
+COUNTERS = {}
+
+
+def peak_rss() -> int:
+    """
+    Return the peak resident set size of the process in bytes, or None if it cannot be determined.
+    """
+    try:
+        with open('/proc/self/status', 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss is given in kilobytes on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the process to its current size if the platform supports it, which is only the case on Linux.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='utf-8') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def cpu_time() -> float:
+    """
+    Return the CPU time in seconds used by the process and its finished child processes, e.g. the workers of a process pool.
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Record the wall time, CPU time and peak resident set size of the stage run within the context.
+    If the peak cannot be reset, which is the case on other platforms than Linux, it is the peak of the process up to the end of the stage.
+    """
+    reset_peak_rss()
+    start_wall, start_cpu = time.perf_counter(), cpu_time()
+    try:
+        yield
+    finally:
+        STAGES.append({
+            'Stage': name,
+            'Wall Seconds': round(time.perf_counter() - start_wall, 3),
+            'CPU Seconds': round(cpu_time() - start_cpu, 3),
+            'Peak RSS Bytes': peak_rss(),
+        })
+        print(f'Stage {name} took {STAGES[-1]["Wall Seconds"]:.1f} seconds.')
+
+
+def count(name: str, value: float = 1):
+    """
+    Add the value to the counter.
+    """
+    COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+
+class Progress:
+    """
+    Progress of a long running loop, which is printed at most once per interval instead of once per item.
+    Loops which finish within the first interval are not reported at all.
+    """
+    def __init__(self, description: str, total: int = None, interval: float = 5):
+        self.description = description
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.reported = False
+        self.start_time = self.last_report = time.monotonic()
+
+    def update(self, value: int = 1):
+        """
+        Advance the progress by the value and print it if the last report is older than the interval, or if the loop is done and has been reported before.
+        """
+        self.done += value
+        now = time.monotonic()
+        if now - self.last_report >= self.interval or (self.reported and self.done == self.total):
+            self.last_report, self.reported = now, True
+            rate = self.done / max(now - self.start_time, 1e-9)
+            print(f'{self.description}: {self.done}{f" of {self.total}" if self.total is not None else ""} after {now - self.start_time:.0f} seconds ({rate:.0f}/s)')
+
+
+def dump_metrics(export_path: str):
+    """
+    Export the stages and counters to a json file, or to a csv file with one row per stage and counter if the path ends with .csv.
+    """
+    if export_path.endswith('.csv'):
+        with open(export_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Type', 'Name', 'Wall Seconds', 'CPU Seconds', 'Peak RSS Bytes', 'Value'])
+            for entry in STAGES:
+                writer.writerow(['stage', entry['Stage'], entry['Wall Seconds'], entry['CPU Seconds'], entry['Peak RSS Bytes'], ''])
+            for name, value in COUNTERS.items():
+                writer.writerow(['counter', name, '', '', '', value])
+    else:
+        with open(export_path, 'w', encoding='utf-8') as f:
+            # Counters of numpy values are converted to the equivalent python values
+            json.dump({'stages': STAGES, 'counters': COUNTERS}, f, indent=2, default=lambda value: value.item())
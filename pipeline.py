@@ -0,0 +1,317 @@
+import argparse
+import ast
+from calculate_optimal_path import aggregate_transitions, find_best_path, graph_from_transitions, path_songs, preprocess_data, refine_path, select_date_range
+from crossreference import match_streams, rematch_streams
+from export_playlist_to_apple_music import get_playlist_id_and_add_songs, resolve_songs
+import hashlib
+from ingest import DAILY_TRACKS_COLUMNS, PLAY_ACTIVITY_COLUMNS, file_hash, read_data
+import json
+from metrics import count, dump_metrics, stage
+import os
+import pandas as pd
+import random
+import shutil
+import sqlite3
+from storage import DATABASE, connect
+from typing import Callable, NamedTuple
+
+
+CACHE_DIRECTORY = '.pipeline_cache'
+EXPORT_PATH = 'calculated_path.sqlite3'
+MODULE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+class Stage(NamedTuple):
+    """
+    Stage of the pipeline, whose outputs are cached under the hash of the keys of its inputs, its parameters and the source code of its modules.
+    The parameters listed as sources are paths of files, which are hashed by their content instead of their name.
+    The modules are hashed along with all local modules they import, e.g. storage.py which defines the dtypes of the streams.
+    """
+    run: Callable
+    inputs: tuple = ()
+    parameters: tuple = ()
+    sources: tuple = ()
+    modules: tuple = ()
+    store: bool = True
+
+
+def ingest(inputs: dict, parameters: dict, workers: int) -> dict:
+    """
+    Read the Play Activity and the Play History Daily Tracks file.
+    """
+    # The parsed files are not stored again, as read_data already caches them next to the csv files
+    return {
+        'play activity': read_data(parameters['play_activity'], columns=PLAY_ACTIVITY_COLUMNS),
+        'daily tracks': read_data(parameters['daily_tracks'], columns=DAILY_TRACKS_COLUMNS),
+    }
+
+
+def crossreference(inputs: dict, parameters: dict, workers: int) -> dict:
+    """
+    Match the streams to their closest track in the daily tracks based on time.
+    """
+    # The number of workers does not change the matches, so it is not part of the key
+    return {'matches': match_streams(inputs['play activity'], inputs['daily tracks'], workers, parameters['window'])}
+
+
+def rematch(inputs: dict, parameters: dict, workers: int) -> dict:
+    """
+    Rematch the streams which could not be matched based on time based on their length.
+    """
+    return {'streams': rematch_streams(inputs['matches'], parameters['tolerance'])}
+
+
+def filter_streams(inputs: dict, parameters: dict, workers: int) -> dict:
+    """
+    Select the streams within the date range.
+    """
+    return {'selected streams': select_date_range(inputs['streams'], parameters['start'], parameters['end'])}
+
+
+def preprocess(inputs: dict, parameters: dict, workers: int) -> dict:
+    """
+    Merge the sessions and remove the skipped streams and the songs played for less than the minimum playtime.
+    """
+    return {'preprocessed streams': preprocess_data(inputs['selected streams'], parameters['skip_threshold'], parameters['minimum_playtime'])}
+
+
+def graph(inputs: dict, parameters: dict, workers: int) -> dict:
+    """
+    Aggregate the transitions between consecutive songs into the weighted edges of the graph.
+    """
+    # Seed the random fuzz of the weights, so the cached transitions can be reproduced
+    random.seed(parameters['seed'])
+    return {'transitions': aggregate_transitions(inputs['preprocessed streams'])}
+
+
+def path(inputs: dict, parameters: dict, workers: int) -> dict:
+    """
+    Walk the graph from several start nodes and refine the best path within the time budget.
+    """
+    G = graph_from_transitions(inputs['transitions'], parameters['half_life'])
+    song_names = find_best_path(G=G, starts=parameters['starts'], strategy=parameters['strategy'], seed=parameters['seed'], workers=workers)
+    if parameters['refine_seconds']:
+        song_names = refine_path(G=G, path=song_names, time_budget=parameters['refine_seconds'])
+    return {'path': pd.DataFrame({'Song Name': song_names})}
+
+
+def export(inputs: dict, parameters: dict, workers: int) -> dict:
+    """
+    Merge the Track Identifier and Media Duration In Milliseconds of the songs into the path.
+    """
+    return {'songs': path_songs(inputs['preprocessed streams'], inputs['path']['Song Name'].tolist())}
+
+
+# Stages of the pipeline in topological order, a change of a module only invalidates the stages which run it or a module importing it
+PIPELINE = {
+    'ingest': Stage(ingest, parameters=('play_activity', 'daily_tracks'), sources=('play_activity', 'daily_tracks'), modules=('ingest.py',), store=False),
+    'crossreference': Stage(crossreference, ('ingest',), ('window',), modules=('crossreference.py',)),
+    'rematch': Stage(rematch, ('crossreference',), ('tolerance',), modules=('crossreference.py',)),
+    'filter': Stage(filter_streams, ('rematch',), ('start', 'end'), modules=('calculate_optimal_path.py',)),
+    'preprocess': Stage(preprocess, ('filter',), ('skip_threshold', 'minimum_playtime'), modules=('calculate_optimal_path.py',)),
+    'graph': Stage(graph, ('preprocess',), ('seed',), modules=('calculate_optimal_path.py',)),
+    'path': Stage(path, ('graph',), ('half_life', 'starts', 'strategy', 'seed', 'refine_seconds'), modules=('calculate_optimal_path.py',)),
+    'export': Stage(export, ('preprocess', 'path'), modules=('calculate_optimal_path.py',)),
+}
+
+
+def source_hash(filename: str, cache_directory: str) -> str:
+    """
+    Calculate the hash of the content of the file, which is only recalculated if its size or modification time changed since it was last hashed.
+    """
+    hashes_filename = os.path.join(cache_directory, 'sources.json')
+    hashes = {}
+    if os.path.exists(hashes_filename):
+        with open(hashes_filename, 'r', encoding='utf-8') as f:
+            hashes = json.load(f)
+
+    stat = os.stat(filename)
+    entry = hashes.get(os.path.abspath(filename))
+    if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+        entry = hashes[os.path.abspath(filename)] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': file_hash(filename)}
+        with open(hashes_filename, 'w', encoding='utf-8') as f:
+            json.dump(hashes, f, indent=2)
+    return entry['hash']
+
+
+def local_imports(module: str) -> set:
+    """
+    Return the module along with all modules of the repository it imports directly or indirectly.
+    """
+    modules, pending = set(), [module]
+    while pending:
+        module = pending.pop()
+        if module in modules:
+            continue
+        modules.add(module)
+        with open(os.path.join(MODULE_DIRECTORY, module), 'r', encoding='utf-8') as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            names = [alias.name for alias in node.names] if isinstance(node, ast.Import) else [node.module] if isinstance(node, ast.ImportFrom) and node.module else []
+            pending += [f'{name}.py' for name in names if os.path.exists(os.path.join(MODULE_DIRECTORY, f'{name}.py'))]
+    return modules
+
+
+def stage_keys(parameters: dict, cache_directory: str = CACHE_DIRECTORY) -> tuple:
+    """
+    Calculate the key of every stage from the keys of its inputs, its parameters and the hashes of its modules without running any stage.
+    Return the keys along with the descriptions they were calculated from.
+    """
+    os.makedirs(cache_directory, exist_ok=True)
+    keys, descriptions = {}, {}
+    for name, definition in PIPELINE.items():
+        descriptions[name] = {
+            'stage': name,
+            'inputs': {input_name: keys[input_name] for input_name in definition.inputs},
+            'parameters': {
+                parameter: source_hash(parameters[parameter], cache_directory) if parameter in definition.sources else parameters[parameter]
+                for parameter in definition.parameters
+            },
+            'modules': {
+                module: file_hash(os.path.join(MODULE_DIRECTORY, module))
+                for module in sorted(set().union(*(local_imports(module) for module in definition.modules)))
+            },
+        }
+        # Timestamps and durations are hashed by their string representation
+        keys[name] = hashlib.blake2b(json.dumps(descriptions[name], sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+    return keys, descriptions
+
+
+def save_outputs(directory: str, outputs: dict, description: dict):
+    """
+    Save the DataFrames of the stage in the Feather format along with the description of its key, replacing the directory only once all files are written.
+    """
+    temporary_directory = directory + '.tmp'
+    shutil.rmtree(temporary_directory, ignore_errors=True)
+    os.makedirs(temporary_directory)
+    for output_name, df in outputs.items():
+        df.reset_index(drop=True).to_feather(os.path.join(temporary_directory, f'{output_name}.feather'))
+    with open(os.path.join(temporary_directory, 'stage.json'), 'w', encoding='utf-8') as f:
+        json.dump(dict(description, outputs=list(outputs)), f, indent=2, default=str)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(temporary_directory, directory)
+
+
+def load_outputs(directory: str) -> dict:
+    """
+    Load the DataFrames of a stage saved by save_outputs.
+    """
+    with open(os.path.join(directory, 'stage.json'), 'r', encoding='utf-8') as f:
+        description = json.load(f)
+    return {output_name: pd.read_feather(os.path.join(directory, f'{output_name}.feather')) for output_name in description['outputs']}
+
+
+def downstream(names: set) -> set:
+    """
+    Return the stages along with all stages which depend on them.
+    """
+    names = set(names)
+    for name, definition in PIPELINE.items():
+        if names.intersection(definition.inputs):
+            names.add(name)
+    return names
+
+
+def run_pipeline(parameters: dict, target: str = 'export', workers: int = 1, cache_directory: str = CACHE_DIRECTORY, force: set = ()) -> dict:
+    """
+    Run the stages the target depends on and return its outputs, loading the outputs of the stages whose key is cached instead of running them.
+    The inputs of a cached stage are not loaded at all, so only the stages after the first changed input or parameter run again.
+    Forced stages and all stages depending on them run again even if they are cached.
+    """
+    keys, descriptions = stage_keys(parameters, cache_directory)
+    force = downstream(force)
+    outputs = {}
+
+    def evaluate(name: str) -> dict:
+        # Every stage is evaluated once, even if several stages depend on it
+        if name in outputs:
+            return outputs[name]
+        definition = PIPELINE[name]
+        directory = os.path.join(cache_directory, f'{name}-{keys[name]}')
+        if definition.store and name not in force and os.path.isdir(directory):
+            print(f'Stage {name} is cached, loading {directory}...')
+            count('cached stages')
+            outputs[name] = load_outputs(directory)
+            return outputs[name]
+
+        inputs = {}
+        for input_name in definition.inputs:
+            inputs.update(evaluate(input_name))
+        with stage(name):
+            outputs[name] = definition.run(inputs, parameters, workers)
+        if definition.store:
+            save_outputs(directory, outputs[name], descriptions[name])
+        return outputs[name]
+
+    return evaluate(target)
+
+
+def prune_cache(keys: dict, cache_directory: str = CACHE_DIRECTORY) -> int:
+    """
+    Delete the cached outputs of all stages whose key differs from the given keys and return the number of deleted entries.
+    """
+    current = {f'{name}-{key}' for name, key in keys.items()}
+    stale = [entry for entry in os.listdir(cache_directory) if os.path.isdir(os.path.join(cache_directory, entry)) and entry not in current]
+    for entry in stale:
+        shutil.rmtree(os.path.join(cache_directory, entry))
+    print(f'Deleted {len(stale)} stale entries from {cache_directory}.')
+    return len(stale)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Crossreference the Apple Music exports and calculate the optimal order of the songs, only running the stages whose inputs changed.')
+    parser.add_argument('play_activity', help='path of the Apple Music Play Activity file')
+    parser.add_argument('daily_tracks', help='path of the Apple Music - Play History Daily Tracks file')
+    parser.add_argument('--start', type=pd.Timestamp, default=None, help='only use the streams from this date on, e.g. 2015-01-01')
+    parser.add_argument('--end', type=pd.Timestamp, default=None, help='only use the streams before this date, e.g. 2024-01-01')
+    parser.add_argument('--window', type=float, default=2, help='hours around a stream in which its track is searched in the daily tracks')
+    parser.add_argument('--tolerance', type=int, default=0, help='milliseconds the media durations may differ by when rematching based on length')
+    parser.add_argument('--skip-threshold', type=float, default=25, help='seconds up to which a stream counts as skipped')
+    parser.add_argument('--minimum-playtime', type=float, default=5, help='minutes a song has to be played in total to be included')
+    parser.add_argument('--half-life', type=float, default=None, help='days after which the weight of a transition is halved, all transitions weigh the same by default')
+    parser.add_argument('--starts', type=int, default=8, help='number of start nodes of the walk')
+    parser.add_argument('--strategy', choices=['random', 'degree'], default='random', help='how the start nodes of the walk are chosen')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the weights of the graph and the start nodes of the walk')
+    parser.add_argument('--refine-seconds', type=float, default=60, help='time budget of the refinement of the path, 0 to skip it')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes of the crossreference and the walk')
+    parser.add_argument('--cache', default=CACHE_DIRECTORY, help='directory of the cached outputs of the stages')
+    parser.add_argument('--force', nargs='+', choices=list(PIPELINE), default=[], help='run these stages and the ones depending on them even if they are cached')
+    parser.add_argument('--prune', action='store_true', help='delete the cached outputs which do not belong to this run')
+    parser.add_argument('--output', default=EXPORT_PATH, help='sqlite3 database the calculated path is exported to')
+    parser.add_argument('--upload', action='store_true', help='upload the calculated path to Apple Music as a new playlist')
+    parser.add_argument('--database', default=DATABASE, help='sqlite3 database the catalog lookups of the upload are cached in')
+    parser.add_argument('--metrics', default='pipeline_metrics.json', help='file the timings and counters are saved to, use a .csv path for a csv file')
+    args = parser.parse_args()
+
+    parameters = {
+        'play_activity': args.play_activity,
+        'daily_tracks': args.daily_tracks,
+        'window': pd.Timedelta(hours=args.window),
+        'tolerance': args.tolerance,
+        'start': args.start,
+        'end': args.end,
+        'skip_threshold': pd.Timedelta(seconds=args.skip_threshold),
+        'minimum_playtime': pd.Timedelta(minutes=args.minimum_playtime),
+        'half_life': pd.Timedelta(days=args.half_life) if args.half_life is not None else None,
+        'starts': args.starts,
+        'strategy': args.strategy,
+        'seed': args.seed,
+        'refine_seconds': args.refine_seconds,
+    }
+    songs = run_pipeline(parameters, workers=args.workers, cache_directory=args.cache, force=set(args.force))['songs']
+    if args.prune:
+        prune_cache(stage_keys(parameters, args.cache)[0], args.cache)
+
+    # Export the path to the database read by export_playlist_to_apple_music.py
+    with sqlite3.connect(args.output) as conn:
+        songs.to_sql('exported_path', conn, if_exists='replace', index=False)
+    print(f'Exported {len(songs)} songs to {args.output}.')
+
+    if args.upload:
+        with stage('preflight'), connect(args.database) as conn:
+            song_ids = resolve_songs(conn, songs['Track Identifier'].astype(int).tolist())
+        with stage('upload'):
+            playlist_id = get_playlist_id_and_add_songs(song_ids)
+        print(f'Songs successfully added to playlist "{playlist_id}".')
+    dump_metrics(args.metrics)
@@ -0,0 +1,386 @@
+import pandas as pd
+import sqlite3
+
+
+DATABASE = 'identified_songs.sqlite3'
+
+# Schema of the 'crossreference' table, timestamps are stored as milliseconds since the epoch
+CROSSREFERENCE_COLUMNS = {
+    'Event Start Timestamp': 'INTEGER NOT NULL',
+    'Song Name': 'TEXT',
+    'Play Duration Milliseconds': 'INTEGER',
+    'Media Duration In Milliseconds': 'INTEGER',
+    'Track Identifier': 'INTEGER',
+}
+CROSSREFERENCE_INDEXES = ['Event Start Timestamp', 'Track Identifier', 'Song Name']
+
+# Compact in-memory dtypes of the streams from the ingestion up to the exported path
+# The timestamps are kept as datetime64, which is stored as int64 nanoseconds since the epoch
+STREAM_DTYPES = {
+    'Event Start Timestamp': 'datetime64[ns]',
+    'Song Name': 'category',
+    'Play Duration Milliseconds': 'Int32',
+    'Media Duration In Milliseconds': 'Int32',
+    'Track Identifier': 'Int64',
+}
+WATERMARK_TABLE = 'crossreference_watermark'
+
+# Schema of the 'transitions' table, which holds the aggregated transitions between two songs with the names in sorted order
+TRANSITIONS_COLUMNS = {
+    'Source': 'TEXT NOT NULL',
+    'Target': 'TEXT NOT NULL',
+    'Count': 'INTEGER NOT NULL',
+    'Weight': 'REAL NOT NULL',
+    'Last Seen Timestamp': 'INTEGER NOT NULL',
+}
+TRANSITIONS_WATERMARK_TABLE = 'transitions_watermark'
+
+# Schema of the 'song_totals' table, which holds the playtime and number of sessions of every song the transitions have been folded from
+SONG_TOTALS_COLUMNS = {
+    'Song Name': 'TEXT NOT NULL PRIMARY KEY',
+    'Track Identifier': 'INTEGER',
+    'Media Duration In Milliseconds': 'INTEGER',
+    'Playtime Milliseconds': 'INTEGER NOT NULL',
+    'Plays': 'INTEGER NOT NULL',
+}
+
+# Schema of the state of the transition store, the checksum of the streams up to the watermark tells whether earlier streams were deleted or changed
+TRANSITIONS_STATE_TABLE = 'transitions_state'
+TRANSITIONS_STATE_COLUMNS = {
+    'Skip Threshold Milliseconds': 'INTEGER NOT NULL',
+    'Last Song Name': 'TEXT',
+    'Last Timestamp': 'INTEGER',
+    'Streams': 'INTEGER NOT NULL',
+    'Identifier Sum': 'INTEGER NOT NULL',
+    'Duration Sum': 'INTEGER NOT NULL',
+}
+
+# Schema of the 'catalog' table, which caches the catalog id of every track identifier per storefront, NULL if neither the song nor an equivalent is available
+CATALOG_COLUMNS = {
+    'Storefront': 'TEXT NOT NULL',
+    'Track Identifier': 'INTEGER NOT NULL',
+    'Catalog Identifier': 'TEXT',
+    'Checked Timestamp': 'INTEGER NOT NULL',
+}
+
+
+def connect(database: str = DATABASE) -> sqlite3.Connection:
+    """
+    Connect to the database in WAL mode and make sure the 'crossreference' table and its indexes exist.
+    Tables written by earlier versions with pandas.to_sql are migrated to the typed schema once.
+    """
+    conn = sqlite3.connect(database)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+
+    # Migrate a table with text timestamps to the typed schema
+    column_types = {name: column_type for _, name, column_type, *_ in conn.execute('PRAGMA table_info(crossreference)')}
+    if column_types and column_types.get('Event Start Timestamp') != 'INTEGER':
+        print('Migrating crossreference table to the typed schema...')
+        df = pd.read_sql('SELECT * FROM crossreference', conn)
+        df['Event Start Timestamp'] = pd.to_datetime(df['Event Start Timestamp'], format='ISO8601')
+        conn.execute('DROP TABLE crossreference')
+        conn.execute(f'DROP TABLE IF EXISTS {WATERMARK_TABLE}')
+        create_schema(conn)
+        write_crossreference(conn, df)
+    else:
+        create_schema(conn)
+
+    return conn
+
+
+def create_schema(conn: sqlite3.Connection):
+    """
+    Create the 'crossreference' table with its indexes, the 'transitions', 'song_totals' and 'catalog' table if they do not exist yet.
+    """
+    columns = ', '.join(f'"{name}" {column_type}' for name, column_type in CROSSREFERENCE_COLUMNS.items())
+    conn.execute(f'CREATE TABLE IF NOT EXISTS crossreference ({columns})')
+    for column in CROSSREFERENCE_INDEXES:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS "crossreference_{column.lower().replace(" ", "_")}" ON crossreference ("{column}")')
+    columns = ', '.join(f'"{name}" {column_type}' for name, column_type in TRANSITIONS_COLUMNS.items())
+    conn.execute(f'CREATE TABLE IF NOT EXISTS transitions ({columns}, PRIMARY KEY ("Source", "Target"))')
+    columns = ', '.join(f'"{name}" {column_type}' for name, column_type in SONG_TOTALS_COLUMNS.items())
+    conn.execute(f'CREATE TABLE IF NOT EXISTS song_totals ({columns})')
+    columns = ', '.join(f'"{name}" {column_type}' for name, column_type in CATALOG_COLUMNS.items())
+    conn.execute(f'CREATE TABLE IF NOT EXISTS catalog ({columns}, PRIMARY KEY ("Storefront", "Track Identifier"))')
+    conn.commit()
+
+
+def compact_streams(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert the columns of the streams to the compact dtypes of STREAM_DTYPES, other columns are kept as they are.
+    """
+    return df.astype({column: dtype for column, dtype in STREAM_DTYPES.items() if column in df.columns})
+
+
+def to_milliseconds(timestamps: pd.Series) -> pd.Series:
+    """
+    Convert timezone-naive timestamps to milliseconds since the epoch.
+    """
+    return pd.to_datetime(timestamps).astype('datetime64[ms]').astype('int64')
+
+
+def to_millisecond(timestamp: pd.Timestamp) -> int:
+    """
+    Convert a timezone-naive timestamp to milliseconds since the epoch.
+    """
+    return pd.Timestamp(timestamp).value // 1_000_000
+
+
+def read_crossreference(conn: sqlite3.Connection, columns: list = None, start: pd.Timestamp = None, end: pd.Timestamp = None, identified: bool = None, rowid: bool = False) -> pd.DataFrame:
+    """
+    Read the streams from the 'crossreference' table sorted by 'Event Start Timestamp'.
+    The date range [start, end) and whether the streams have to be identified (True) or unidentified (False) are filtered in SQL.
+    """
+    conditions, parameters = [], []
+    if start is not None:
+        conditions.append('"Event Start Timestamp" >= ?')
+        parameters.append(to_millisecond(start))
+    if end is not None:
+        conditions.append('"Event Start Timestamp" < ?')
+        parameters.append(to_millisecond(end))
+    if identified is not None:
+        conditions.append(f'"Track Identifier" IS {"NOT " if identified else ""}NULL')
+
+    selection = ', '.join((['rowid'] if rowid else []) + [f'"{column}"' for column in columns or CROSSREFERENCE_COLUMNS])
+    where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+    df = pd.read_sql(f'SELECT {selection} FROM crossreference{where} ORDER BY "Event Start Timestamp", rowid', conn, params=parameters)
+    if 'Event Start Timestamp' in df.columns:
+        df['Event Start Timestamp'] = pd.to_datetime(df['Event Start Timestamp'], unit='ms')
+    return compact_streams(df)
+
+
+def read_crossreference_chunks(conn: sqlite3.Connection, columns: list = None, chunk_size: int = 1_000_000):
+    """
+    Read the streams from the 'crossreference' table sorted by 'Event Start Timestamp' in chunks of rows, so the table never has to fit into memory as a whole.
+    """
+    selection = ', '.join(f'"{column}"' for column in columns or CROSSREFERENCE_COLUMNS)
+    for df in pd.read_sql(f'SELECT {selection} FROM crossreference ORDER BY "Event Start Timestamp", rowid', conn, chunksize=chunk_size):
+        if 'Event Start Timestamp' in df.columns:
+            df['Event Start Timestamp'] = pd.to_datetime(df['Event Start Timestamp'], unit='ms')
+        yield compact_streams(df)
+
+
+def read_first_identified(conn: sqlite3.Connection) -> pd.DataFrame:
+    """
+    Read the first identified stream of every song name and media duration, which are the only candidates for rematching based on length.
+    """
+    return compact_streams(pd.read_sql(
+        'SELECT "Song Name", "Media Duration In Milliseconds", "Track Identifier" FROM ('
+        '  SELECT "Song Name", "Media Duration In Milliseconds", "Track Identifier", ROW_NUMBER() OVER ('
+        '    PARTITION BY "Song Name", "Media Duration In Milliseconds" ORDER BY "Event Start Timestamp", rowid'
+        '  ) AS position, "Event Start Timestamp", rowid FROM crossreference WHERE "Track Identifier" IS NOT NULL'
+        ') WHERE position = 1 ORDER BY "Event Start Timestamp", rowid',
+        conn
+    ))
+
+
+def write_crossreference(conn: sqlite3.Connection, df: pd.DataFrame, replace: bool = False, chunk_size: int = 100_000):
+    """
+    Insert the streams into the 'crossreference' table in chunks, replacing all existing streams if requested.
+    """
+    if replace:
+        conn.execute('DELETE FROM crossreference')
+
+    # Convert the values to the types of the schema, with None for missing values
+    df = df.loc[:, list(CROSSREFERENCE_COLUMNS)]
+    df = df.assign(**{'Event Start Timestamp': to_milliseconds(df['Event Start Timestamp'])}).astype(object)
+    df = df.where(df.notna(), None)
+    for column in ('Event Start Timestamp', 'Play Duration Milliseconds', 'Media Duration In Milliseconds', 'Track Identifier'):
+        df[column] = [int(value) if value is not None else None for value in df[column]]
+
+    placeholders = ', '.join('?' * len(CROSSREFERENCE_COLUMNS))
+    for chunk_start in range(0, len(df), chunk_size):
+        conn.executemany(f'INSERT INTO crossreference VALUES ({placeholders})', df.iloc[chunk_start:chunk_start + chunk_size].itertuples(index=False, name=None))
+    conn.commit()
+
+
+def update_matches(conn: sqlite3.Connection, df: pd.DataFrame) -> int:
+    """
+    Update the 'Song Name' and 'Track Identifier' of the identified streams by their rowid and return the number of updated streams.
+    """
+    df = df[df['Track Identifier'].notna()]
+    conn.executemany(
+        'UPDATE crossreference SET "Song Name" = ?, "Track Identifier" = ? WHERE rowid = ?',
+        zip(df['Song Name'], df['Track Identifier'].astype('int64').tolist(), df['rowid'].astype('int64').tolist())
+    )
+    conn.commit()
+    return len(df)
+
+
+def delete_outside(conn: sqlite3.Connection, start: pd.Timestamp, end: pd.Timestamp) -> int:
+    """
+    Delete all streams outside of the date range [start, end) and return the number of deleted streams.
+    """
+    cursor = conn.execute(
+        'DELETE FROM crossreference WHERE "Event Start Timestamp" < ? OR "Event Start Timestamp" >= ?',
+        (to_millisecond(start), to_millisecond(end))
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+def count_matches(conn: sqlite3.Connection) -> tuple:
+    """
+    Return the number of identified and unidentified streams.
+    """
+    return conn.execute('SELECT COUNT("Track Identifier"), COUNT(*) - COUNT("Track Identifier") FROM crossreference').fetchone()
+
+
+def update_transitions(conn: sqlite3.Connection, transitions: pd.DataFrame, chunk_size: int = 100_000):
+    """
+    Add the counts and weights of the transitions to the 'transitions' table, keeping the latest timestamp each transition was seen at.
+    """
+    transitions = transitions.assign(**{'Last Seen Timestamp': to_milliseconds(transitions['Last Seen Timestamp'])})
+    rows = list(zip(
+        transitions['Source'], transitions['Target'], transitions['Count'].astype('int64').tolist(),
+        transitions['Weight'].astype(float).tolist(), transitions['Last Seen Timestamp'].tolist()
+    ))
+    for chunk_start in range(0, len(rows), chunk_size):
+        conn.executemany(
+            'INSERT INTO transitions VALUES (?, ?, ?, ?, ?) ON CONFLICT ("Source", "Target") DO UPDATE SET '
+            '"Count" = "Count" + excluded."Count", "Weight" = "Weight" + excluded."Weight", '
+            '"Last Seen Timestamp" = MAX("Last Seen Timestamp", excluded."Last Seen Timestamp")',
+            rows[chunk_start:chunk_start + chunk_size]
+        )
+    conn.commit()
+
+
+def played_songs(minimum_playtime: pd.Timedelta) -> tuple:
+    """
+    Return the SQL query of the songs played for more than the minimum playtime and more than once in total along with its parameters.
+    """
+    return 'SELECT "Song Name" FROM song_totals WHERE "Playtime Milliseconds" > ? AND "Plays" > 1', [minimum_playtime // pd.Timedelta(milliseconds=1)]
+
+
+def read_transitions(conn: sqlite3.Connection, minimum_playtime: pd.Timedelta = None) -> pd.DataFrame:
+    """
+    Read the transitions in the order they were first seen, only keeping the transitions between songs played for more than the minimum playtime
+    and more than once in total if a minimum playtime is given.
+    """
+    columns = ', '.join(f'"{column}"' for column in TRANSITIONS_COLUMNS)
+    where, parameters = '', []
+    if minimum_playtime is not None:
+        songs, parameters = played_songs(minimum_playtime)
+        where, parameters = f' WHERE "Source" IN ({songs}) AND "Target" IN ({songs})', parameters * 2
+    df = pd.read_sql(f'SELECT {columns} FROM transitions{where} ORDER BY rowid', conn, params=parameters)
+    df['Last Seen Timestamp'] = pd.to_datetime(df['Last Seen Timestamp'], unit='ms')
+    return df
+
+
+def update_song_totals(conn: sqlite3.Connection, totals: pd.DataFrame):
+    """
+    Add the playtime and plays to the 'song_totals' table, keeping the first Track Identifier and Media Duration In Milliseconds of every song.
+    """
+    rows = [
+        (name, int(identifier) if pd.notna(identifier) else None, int(duration) if pd.notna(duration) else None, int(playtime), int(plays))
+        for name, identifier, duration, playtime, plays in totals[list(SONG_TOTALS_COLUMNS)].itertuples(index=False, name=None)
+    ]
+    conn.executemany(
+        'INSERT INTO song_totals VALUES (?, ?, ?, ?, ?) ON CONFLICT ("Song Name") DO UPDATE SET '
+        '"Track Identifier" = COALESCE("Track Identifier", excluded."Track Identifier"), '
+        '"Media Duration In Milliseconds" = COALESCE("Media Duration In Milliseconds", excluded."Media Duration In Milliseconds"), '
+        '"Playtime Milliseconds" = "Playtime Milliseconds" + excluded."Playtime Milliseconds", "Plays" = "Plays" + excluded."Plays"',
+        rows
+    )
+    conn.commit()
+
+
+def read_song_totals(conn: sqlite3.Connection, minimum_playtime: pd.Timedelta = None) -> pd.DataFrame:
+    """
+    Read the songs along with their Track Identifier, Media Duration In Milliseconds and totals, only keeping the songs played for more than the
+    minimum playtime and more than once in total if a minimum playtime is given.
+    """
+    columns = ', '.join(f'"{column}"' for column in SONG_TOTALS_COLUMNS)
+    where, parameters = '', []
+    if minimum_playtime is not None:
+        songs, parameters = played_songs(minimum_playtime)
+        where = f' WHERE "Song Name" IN ({songs})'
+    return compact_streams(pd.read_sql(f'SELECT {columns} FROM song_totals{where} ORDER BY rowid', conn, params=parameters))
+
+
+def streams_checksum(conn: sqlite3.Connection, until: pd.Timestamp) -> tuple:
+    """
+    Return the number of streams up to the timestamp along with the sums of their Track Identifier and Play Duration Milliseconds.
+    Deleting or rematching any of these streams changes the checksum, without having to read them.
+    """
+    return conn.execute(
+        'SELECT COUNT(*), COALESCE(SUM("Track Identifier"), 0), COALESCE(SUM("Play Duration Milliseconds"), 0) FROM crossreference WHERE "Event Start Timestamp" <= ?',
+        (to_millisecond(until),)
+    ).fetchone()
+
+
+def read_transitions_state(conn: sqlite3.Connection) -> dict:
+    """
+    Read the state of the transition store, or None if nothing has been folded yet.
+    """
+    columns = ', '.join(f'"{name}" {column_type}' for name, column_type in TRANSITIONS_STATE_COLUMNS.items())
+    conn.execute(f'CREATE TABLE IF NOT EXISTS {TRANSITIONS_STATE_TABLE} ({columns})')
+    row = conn.execute(f'SELECT * FROM {TRANSITIONS_STATE_TABLE}').fetchone()
+    return dict(zip(TRANSITIONS_STATE_COLUMNS, row)) if row is not None else None
+
+
+def write_transitions_state(conn: sqlite3.Connection, state: dict):
+    """
+    Store the state of the transition store.
+    """
+    read_transitions_state(conn)
+    conn.execute(f'DELETE FROM {TRANSITIONS_STATE_TABLE}')
+    conn.execute(f'INSERT INTO {TRANSITIONS_STATE_TABLE} VALUES ({", ".join("?" * len(TRANSITIONS_STATE_COLUMNS))})', [state[column] for column in TRANSITIONS_STATE_COLUMNS])
+    conn.commit()
+
+
+def clear_transitions(conn: sqlite3.Connection):
+    """
+    Delete all transitions and song totals along with their watermark and state.
+    """
+    conn.execute('DELETE FROM transitions')
+    conn.execute('DELETE FROM song_totals')
+    conn.execute(f'DROP TABLE IF EXISTS {TRANSITIONS_WATERMARK_TABLE}')
+    conn.execute(f'DROP TABLE IF EXISTS {TRANSITIONS_STATE_TABLE}')
+    conn.execute('DROP TABLE IF EXISTS transitions_fingerprint')
+    conn.commit()
+
+
+def read_catalog(conn: sqlite3.Connection, storefront: str, checked_after: pd.Timestamp) -> dict:
+    """
+    Read the catalog ids of the track identifiers of the storefront which have been checked after the given timestamp, with None for unavailable songs.
+    """
+    rows = conn.execute(
+        'SELECT "Track Identifier", "Catalog Identifier" FROM catalog WHERE "Storefront" = ? AND "Checked Timestamp" > ?',
+        (storefront, to_millisecond(checked_after))
+    )
+    return dict(rows.fetchall())
+
+
+def write_catalog(conn: sqlite3.Connection, storefront: str, catalog_ids: dict, checked: pd.Timestamp):
+    """
+    Store the catalog ids of the track identifiers of the storefront along with the timestamp they were checked at, replacing older entries.
+    """
+    conn.executemany(
+        'INSERT OR REPLACE INTO catalog VALUES (?, ?, ?, ?)',
+        [(storefront, int(track_identifier), catalog_id, to_millisecond(checked)) for track_identifier, catalog_id in catalog_ids.items()]
+    )
+    conn.commit()
+
+
+def read_watermark(conn: sqlite3.Connection, table: str = WATERMARK_TABLE) -> pd.Timestamp:
+    """
+    Read the timestamp of the latest stream processed by a stage, falling back to the latest stream in the 'crossreference' table for the crossreference itself.
+    """
+    conn.execute(f'CREATE TABLE IF NOT EXISTS {table} ("Event Start Timestamp" INTEGER NOT NULL)')
+    watermark = conn.execute(f'SELECT "Event Start Timestamp" FROM {table}').fetchone()
+    if watermark is None:
+        watermark = conn.execute('SELECT MAX("Event Start Timestamp") FROM crossreference').fetchone() if table == WATERMARK_TABLE else (None,)
+    return pd.to_datetime(watermark[0], unit='ms') if watermark[0] is not None else pd.Timestamp.min
+
+
+def write_watermark(conn: sqlite3.Connection, watermark: pd.Timestamp, table: str = WATERMARK_TABLE):
+    """
+    Store the timestamp of the latest stream processed by a stage.
+    """
+    conn.execute(f'CREATE TABLE IF NOT EXISTS {table} ("Event Start Timestamp" INTEGER NOT NULL)')
+    conn.execute(f'DELETE FROM {table}')
+    conn.execute(f'INSERT INTO {table} VALUES (?)', (to_millisecond(watermark),))
+    conn.commit()
+
@@ -0,0 +1,86 @@
+import os
+import pandas as pd
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from calculate_optimal_path import fold_transitions
+from storage import connect, read_song_totals, read_transitions, update_matches, write_crossreference
+
+
+def streams(names: list, start: str = '2020-01-01') -> pd.DataFrame:
+    """
+    Create identified streams of the songs, one per hour and each played for a minute.
+    """
+    return pd.DataFrame({
+        'Event Start Timestamp': pd.date_range(start, periods=len(names), freq='h'),
+        'Song Name': names,
+        'Play Duration Milliseconds': 60_000,
+        'Media Duration In Milliseconds': 180_000,
+        'Track Identifier': [sum(map(ord, name)) for name in names],
+    })
+
+
+def stored_pairs(conn, minimum_playtime: pd.Timedelta = None) -> dict:
+    """
+    Return the stored transition counts per pair of songs.
+    """
+    transitions = read_transitions(conn, minimum_playtime=minimum_playtime)
+    return dict(zip(zip(transitions['Source'], transitions['Target']), transitions['Count']))
+
+
+def test_folding_twice_equals_folding_once(tmp_path):
+    df = streams(['a', 'b', 'c', 'a', 'b', 'd', 'a', 'b', 'e'])
+    with connect(str(tmp_path / 'once.sqlite3')) as conn:
+        write_crossreference(conn, df)
+        fold_transitions(conn)
+        once = stored_pairs(conn)
+        totals = read_song_totals(conn)
+    with connect(str(tmp_path / 'twice.sqlite3')) as conn:
+        write_crossreference(conn, df.iloc[:4])
+        assert fold_transitions(conn) == 2
+        write_crossreference(conn, df.iloc[4:])
+        assert fold_transitions(conn) == 5
+        assert fold_transitions(conn) == 0
+        assert stored_pairs(conn) == once
+        pd.testing.assert_frame_equal(read_song_totals(conn), totals)
+    # The last session is held back, as it might still continue
+    assert sum(once.values()) == 7
+    assert set(totals['Song Name']) == {'a', 'b', 'c', 'd'}
+
+
+def test_fold_rebuilds_when_earlier_streams_were_deleted(tmp_path):
+    df = streams(['a', 'b', 'c', 'a', 'b', 'c', 'a'])
+    with connect(str(tmp_path / 'songs.sqlite3')) as conn:
+        write_crossreference(conn, df)
+        fold_transitions(conn)
+        conn.execute('DELETE FROM crossreference WHERE "Song Name" = ?', ('c',))
+        conn.commit()
+        fold_transitions(conn)
+        assert stored_pairs(conn) == {('a', 'b'): 3}
+        assert 'c' not in set(read_song_totals(conn)['Song Name'])
+
+
+def test_fold_rebuilds_when_earlier_streams_were_rematched(tmp_path):
+    df = streams(['a', 'b', 'c', 'a']).assign(**{'Track Identifier': [1, None, 3, 1]})
+    with connect(str(tmp_path / 'songs.sqlite3')) as conn:
+        write_crossreference(conn, df)
+        fold_transitions(conn)
+        assert stored_pairs(conn) == {('a', 'c'): 1}
+        update_matches(conn, pd.DataFrame({'rowid': [2], 'Song Name': ['b'], 'Track Identifier': [2]}))
+        fold_transitions(conn)
+        assert stored_pairs(conn) == {('a', 'b'): 1, ('b', 'c'): 1}
+
+
+def test_song_passing_the_minimum_later_keeps_its_transitions(tmp_path):
+    df = streams(['a', 'b', 'a', 'b', 'c', 'a', 'b', 'c', 'a', 'b'])
+    minimum_playtime = pd.Timedelta(seconds=90)
+    with connect(str(tmp_path / 'songs.sqlite3')) as conn:
+        write_crossreference(conn, df.iloc[:6])
+        fold_transitions(conn)
+        # Song c has only been played once so far, so its transitions are filtered when reading
+        assert stored_pairs(conn, minimum_playtime) == {('a', 'b'): 3}
+        write_crossreference(conn, df.iloc[6:])
+        # Only the new transitions are folded, starting from the last folded song c
+        assert fold_transitions(conn) == 4
+        assert stored_pairs(conn, minimum_playtime) == {('a', 'b'): 4, ('b', 'c'): 2, ('a', 'c'): 2}
+        assert list(read_song_totals(conn, minimum_playtime)['Song Name']) == ['a', 'b', 'c']
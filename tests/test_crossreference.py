@@ -0,0 +1,147 @@
+import numpy as np
+import os
+import pandas as pd
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from crossreference import crossreference, find_closest_matches, prepare_daily_tracks, prepare_play_activity, rematch_based_on_length
+
+
+def streams(names: list, durations: list, identifiers: list) -> pd.DataFrame:
+    """
+    Create streams with the columns used by the rematch.
+    """
+    return pd.DataFrame({
+        'Song Name': pd.Series(names, dtype=object),
+        'Media Duration In Milliseconds': pd.array(durations, dtype='Int32'),
+        'Track Identifier': pd.array(identifiers, dtype='Int64'),
+    })
+
+
+def find_closest_match(row: pd.Series, df: pd.DataFrame) -> pd.Series:
+    """
+    Match the song to the closest Track Description within 2 hours that contains its Song Name, like the row-by-row matching before find_closest_matches.
+    """
+    if pd.isna(row['Track Identifier']):
+        mask = (
+            df['Event Timestamp'].between(row['Event Start Timestamp'] - pd.Timedelta(hours=2), row['Event Start Timestamp'] + pd.Timedelta(hours=2)) &
+            df['Track Description'].str.contains(row['Song Name'], case=False, regex=False, na=False)
+        )
+        matches = df[mask]
+        if not matches.empty:
+            closest_match = matches[abs(matches['Event Timestamp'] - row['Event Start Timestamp']) == abs(matches['Event Timestamp'] - row['Event Start Timestamp']).min()].iloc[0]
+            row['Song Name'] = closest_match['Track Description']
+            row['Track Identifier'] = closest_match['Track Identifier']
+    return row
+
+
+def listening_history(streams: int, daily_tracks: int, seed: int) -> tuple:
+    """
+    Generate Play Activity and Daily Tracks files over three days with a few overlapping names, where the streams start on full or half hours
+    so that many candidates are equally far away or exactly on the boundary of the time window.
+    """
+    rng = np.random.default_rng(seed)
+    names = ['Love', 'love song', 'Rain', 'DROPS', 'Sun', 'Moon']
+    descriptions = ['Artist - Love', 'Artist - Love Song', 'Other - Rain', 'Band - Rain Drops', 'Band - Sun', 'Band - Sun']
+    starts = pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 3 * 48, size=streams) * 30, unit='min')
+    starts = starts + pd.to_timedelta(np.where(rng.random(streams) < 0.2, rng.integers(1, 1800, size=streams), 0), unit='s')
+    play_activity = pd.DataFrame({
+        'Event Start Timestamp': starts.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'Song Name': rng.choice(names, size=streams),
+        'Play Duration Milliseconds': 100000,
+        'Media Duration In Milliseconds': 200000,
+    })
+    daily = pd.DataFrame({
+        'Date Played': rng.choice(['20200101', '20200102', '20200103'], size=daily_tracks),
+        'Hours': [','.join(map(str, sorted(rng.choice(24, size=rng.integers(1, 4), replace=False)))) for _ in range(daily_tracks)],
+        'Track Description': rng.choice(descriptions, size=daily_tracks),
+        'Track Identifier': np.arange(1, daily_tracks + 1),
+    })
+    return play_activity, daily
+
+
+def test_closest_matches_equal_row_by_row_matching():
+    play_activity, daily_tracks = listening_history(300, 60, seed=0)
+    df1, df2 = prepare_play_activity(play_activity), prepare_daily_tracks(daily_tracks)
+
+    expected = df1.astype({'Song Name': object}).assign(**{'Track Identifier': pd.NA}).apply(find_closest_match, axis=1, df=df2)
+    matched = find_closest_matches(df1, df2)
+    assert matched['Song Name'].astype(object).tolist() == expected['Song Name'].tolist()
+    assert matched['Track Identifier'].tolist() == pd.array(expected['Track Identifier'], dtype='Int64').tolist()
+
+    # The history contains equally close candidates with different identifiers and candidates exactly 2 hours away
+    distances = (df2['Event Timestamp'].to_numpy()[None, :] - df1['Event Start Timestamp'].to_numpy()[:, None]).astype('timedelta64[m]').astype(np.int64)
+    assert (np.abs(distances) == 120).any()
+    assert ((distances[:, :, None] == -distances[:, None, :]) & (distances[:, :, None] != 0)).any()
+
+
+def test_closest_match_ties_and_window_boundary():
+    play_activity = pd.DataFrame({
+        'Event Start Timestamp': ['2020-01-01T12:00:00Z', '2020-01-01T12:30:00Z', '2020-01-01T12:00:01Z'],
+        'Song Name': ['Sun', 'Rain', 'Moon'],
+        'Play Duration Milliseconds': [100000, 100000, 100000],
+        'Media Duration In Milliseconds': [200000, 200000, 200000],
+    })
+    daily_tracks = pd.DataFrame({
+        'Date Played': ['20200101', '20200101', '20200101', '20200101', '20200101'],
+        'Hours': ['14', '10', '13', '12', '10'],
+        'Track Description': ['Band - Sun', 'Band - Sun', 'Other - Rain', 'Other - Rain', 'Band - Moon'],
+        'Track Identifier': [1, 2, 3, 4, 5],
+    })
+    df = find_closest_matches(prepare_play_activity(play_activity), prepare_daily_tracks(daily_tracks))
+    # Both candidates exactly 2 hours away are within the window and the first row wins the tie, the candidate 2 hours and 1 second away is not
+    assert df['Track Identifier'].tolist() == [1, 3, pd.NA]
+
+
+def test_rematch_all_identified():
+    df = streams(['Love', 'Rain'], [200000, 210000], [1, 2])
+    pd.testing.assert_frame_equal(rematch_based_on_length(df), df)
+
+
+def test_rematch_no_streams():
+    df = streams([], [], [])
+    pd.testing.assert_frame_equal(rematch_based_on_length(df), df)
+
+
+def test_rematch_only_unnamed_unmatched():
+    df = streams(['Love', None], [200000, 200000], [1, None])
+    pd.testing.assert_frame_equal(rematch_based_on_length(df), df)
+
+
+def test_rematch_contained_name_with_same_length():
+    df = rematch_based_on_length(streams(['Love Song', 'love', 'Love'], [200000, 200000, 190000], [1, None, None]))
+    assert df['Track Identifier'].tolist() == [1, 1, pd.NA]
+    assert df['Song Name'].tolist() == ['Love Song', 'Love Song', 'Love']
+
+
+def test_crossreference_all_matched_by_time():
+    play_activity = pd.DataFrame({
+        'Event Start Timestamp': ['2020-01-01T10:10:00Z', '2020-01-01T11:10:00Z'],
+        'Song Name': ['Love', 'Rain'],
+        'Play Duration Milliseconds': [100000, 100000],
+        'Media Duration In Milliseconds': [200000, 210000],
+    })
+    daily_tracks = pd.DataFrame({
+        'Date Played': ['20200101', '20200101'],
+        'Hours': ['10', '11'],
+        'Track Description': ['Artist - Love', 'Artist - Rain'],
+        'Track Identifier': [1, 2],
+    })
+    df = crossreference(play_activity, daily_tracks)
+    assert df['Track Identifier'].tolist() == [1, 2]
+    assert df['Song Name'].tolist() == ['Artist - Love', 'Artist - Rain']
+
+
+def test_play_activity_timestamps_are_local_times():
+    play_activity = pd.DataFrame({
+        'Event Start Timestamp': ['2020-06-01T10:00:00Z', '2020-06-01T12:00:00.500+02:00', None],
+        'Song Name': ['Love', 'Rain', 'Sun'],
+        'Play Duration Milliseconds': [100000, 100000, 100000],
+        'Media Duration In Milliseconds': [200000, 210000, 220000],
+    })
+    # Without the offset to UTC the local time written in the timestamp is kept, with it the timestamps are shifted to the local time
+    df = prepare_play_activity(play_activity.copy())
+    assert df['Event Start Timestamp'].tolist() == [pd.Timestamp('2020-06-01 10:00:00'), pd.Timestamp('2020-06-01 12:00:00.500')]
+    df = prepare_play_activity(play_activity.assign(**{'UTC Offset In Seconds': pd.array([7200, 7200, 7200], dtype='Int32')}))
+    assert df['Event Start Timestamp'].tolist() == [pd.Timestamp('2020-06-01 12:00:00'), pd.Timestamp('2020-06-01 12:00:00.500')]
+    assert 'UTC Offset In Seconds' not in df.columns
@@ -0,0 +1,36 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+import export_playlist_to_apple_music
+from export_playlist_to_apple_music import get_playlist_id_and_add_songs
+from mock_apple_music import MockAppleMusic
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def short_backoff(monkeypatch):
+    monkeypatch.setattr(export_playlist_to_apple_music.Backoff.__init__, '__defaults__', (0.001, 0.01))
+
+
+@pytest.mark.parametrize('fail_after_add_every', [0, 2, 3])
+@pytest.mark.parametrize('throttle_every', [0, 5])
+def test_upload_keeps_the_order_without_duplicates(fail_after_add_every, throttle_every):
+    song_ids = list(range(1000, 1450))
+    unavailable = song_ids[::37]
+    equivalents = {song_id: song_id + 10 ** 6 for song_id in unavailable[::2]}
+    with MockAppleMusic(unavailable=unavailable, equivalents=equivalents, throttle_every=throttle_every, fail_after_add_every=fail_after_add_every) as mock:
+        playlist_id = get_playlist_id_and_add_songs(song_ids, host=mock.url)
+        uploaded = mock.playlists[playlist_id]
+    assert uploaded == [str(equivalents.get(song_id, song_id)) for song_id in song_ids if song_id not in unavailable or song_id in equivalents]
+
+
+@pytest.mark.parametrize('create_failures, creates', [(('503',), 2), (('504',), 1), (('close',), 1), (('503', 'close'), 2)])
+def test_failed_playlist_creation_is_only_retried_if_the_playlist_does_not_exist(create_failures, creates):
+    song_ids = list(range(1000, 1010))
+    with MockAppleMusic(create_failures=create_failures) as mock:
+        playlist_id = get_playlist_id_and_add_songs(song_ids, host=mock.url)
+        assert mock.requests['create playlist'] == creates
+        assert list(mock.playlists) == [playlist_id]
+        assert mock.playlists[playlist_id] == [str(song_id) for song_id in song_ids]
@@ -0,0 +1,40 @@
+import os
+import pandas as pd
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline import PIPELINE, local_imports, stage_keys
+
+
+def parameters(play_activity: str, daily_tracks: str, **changes) -> dict:
+    """
+    Return the default parameters of the pipeline with the given changes.
+    """
+    return dict({
+        'play_activity': play_activity, 'daily_tracks': daily_tracks, 'window': pd.Timedelta(hours=2), 'tolerance': 0, 'start': None, 'end': None,
+        'skip_threshold': pd.Timedelta(seconds=25), 'minimum_playtime': pd.Timedelta(minutes=5), 'half_life': None, 'starts': 8, 'strategy': 'random',
+        'seed': 0, 'refine_seconds': 60,
+    }, **changes)
+
+
+def test_stages_hash_the_modules_they_import():
+    for name in ('crossreference', 'rematch', 'preprocess', 'export'):
+        modules = set().union(*(local_imports(module) for module in PIPELINE[name].modules))
+        assert 'storage.py' in modules, name
+    assert 'text_index.py' in local_imports('crossreference.py')
+
+
+def test_only_stages_after_a_changed_parameter_get_new_keys(tmp_path):
+    play_activity, daily_tracks = tmp_path / 'play_activity.csv', tmp_path / 'daily_tracks.csv'
+    play_activity.write_text('Event Start Timestamp,Song Name\n', encoding='utf-8')
+    daily_tracks.write_text('Date Played,Hours\n', encoding='utf-8')
+    keys, _ = stage_keys(parameters(str(play_activity), str(daily_tracks)), str(tmp_path / 'cache'))
+
+    changed, _ = stage_keys(parameters(str(play_activity), str(daily_tracks), minimum_playtime=pd.Timedelta(minutes=10)), str(tmp_path / 'cache'))
+    assert [name for name in PIPELINE if keys[name] != changed[name]] == ['preprocess', 'graph', 'path', 'export']
+
+    # The content of the files is hashed, not their modification time
+    os.utime(play_activity, (0, 0))
+    assert stage_keys(parameters(str(play_activity), str(daily_tracks)), str(tmp_path / 'cache'))[0] == keys
+    play_activity.write_text('Event Start Timestamp,Song Name,Play Duration Milliseconds\n', encoding='utf-8')
+    assert stage_keys(parameters(str(play_activity), str(daily_tracks)), str(tmp_path / 'cache'))[0]['ingest'] != keys['ingest']
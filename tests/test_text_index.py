@@ -0,0 +1,63 @@
+import numpy as np
+import os
+import pandas as pd
+import pytest
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from text_index import SubstringIndex
+
+# Values with repeats, non-string values and characters whose casing changes their length
+VALUES = pd.Series([
+    'Love', 'Love Song', 'love song', 'Song', 'Straße', 'STRASSE', 'strasse', 'ﬁre', 'FIRE', 'Fi', 'İstanbul', 'Ǆ', 'ǆ',
+    '', None, np.nan, 3.5, 42, 'Café', 'CAFÉ', 'Love', None,
+])
+QUERIES = [
+    '', 'l', 'L', 'lo', 'ß', 'ss', 'SS', 'fi', 'FI', 'ﬁ', 'é', 'İ', 'ǅ',
+    'love', 'LOVE SONG', 'ove s', 'straße', 'strasse', 'STRASS', 'ﬁre', 'fire', 'café', 'istanbul', 'missing',
+]
+
+
+def expected(values: pd.Series, query: str) -> np.ndarray:
+    """
+    Return the mask pandas calculates for the query.
+    """
+    return values.str.contains(query, case=False, regex=False, na=False).to_numpy(dtype=bool)
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_contains_matches_pandas(query):
+    index = SubstringIndex(VALUES)
+    np.testing.assert_array_equal(index.contains(query), expected(VALUES, query))
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_query_matches_pandas(query):
+    index = SubstringIndex(VALUES)
+    np.testing.assert_array_equal(index.query(query), np.flatnonzero(expected(VALUES, query)))
+
+
+def test_repeated_queries_use_the_same_results():
+    index = SubstringIndex(VALUES)
+    first = index.contains('love')
+    np.testing.assert_array_equal(index.contains('love'), first)
+    np.testing.assert_array_equal(index.contains('LOVE'), first)
+
+
+def test_random_queries_match_pandas():
+    rng = random.Random(0)
+    alphabet = 'abcßsSﬁFIé İ'
+    values = pd.Series([''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 8))) if rng.random() > 0.1 else None for _ in range(500)])
+    index = SubstringIndex(values)
+    for _ in range(500):
+        query = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 5)))
+        np.testing.assert_array_equal(index.contains(query), expected(values, query), err_msg=repr(query))
+        np.testing.assert_array_equal(index.query(query), np.flatnonzero(expected(values, query)), err_msg=repr(query))
+
+
+def test_empty_values():
+    index = SubstringIndex(pd.Series([], dtype=object))
+    assert len(index) == 0
+    assert len(index.contains('love')) == 0
+    assert len(index.query('')) == 0
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+
+class SubstringIndex:
+    """
+    Index over a column of strings which returns the rows containing a query string.
+    The results are the same as the ones of str.contains(query, case=False, regex=False, na=False), but the column is only casefolded and scanned once.
+    """
+    def __init__(self, values: pd.Series, n: int = 3):
+        self.n = n
+
+        # Index the distinct values only, as song names and track descriptions repeat a lot
+        self.codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        self.texts = [value.upper() if isinstance(value, str) else None for value in uniques]
+
+        # Map every n-gram to the distinct values containing it
+        postings = {}
+        for value_id, text in enumerate(self.texts):
+            if text is None:
+                continue
+            for gram in {text[i:i + n] for i in range(len(text) - n + 1)}:
+                postings.setdefault(gram, []).append(value_id)
+        self.postings = {gram: np.array(value_ids, dtype=np.int64) for gram, value_ids in postings.items()}
+
+        # Group the row positions by their distinct value
+        self.row_order = np.argsort(self.codes, kind='stable')
+        self.row_offsets = np.searchsorted(self.codes[self.row_order], np.arange(len(self.texts) + 1))
+        self._cache = {}
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def matching_values(self, query: str) -> np.ndarray:
+        """
+        Return the sorted ids of the distinct values which contain the query.
+        """
+        if query in self._cache:
+            return self._cache[query]
+
+        pattern = query.upper()
+        grams = {pattern[i:i + self.n] for i in range(len(pattern) - self.n + 1)}
+        if grams:
+            # Intersect the postings of the rarest n-grams first, then verify the remaining candidates
+            candidates = None
+            for gram in sorted(grams, key=lambda gram: len(self.postings.get(gram, ()))):
+                if gram not in self.postings:
+                    candidates = np.zeros(0, dtype=np.int64)
+                    break
+                candidates = self.postings[gram] if candidates is None else np.intersect1d(candidates, self.postings[gram], assume_unique=True)
+                if len(candidates) == 0:
+                    break
+        else:
+            # Queries shorter than an n-gram have to be checked against every value
+            candidates = np.arange(len(self.texts), dtype=np.int64)
+
+        value_ids = np.array([value_id for value_id in candidates.tolist() if self.texts[value_id] is not None and pattern in self.texts[value_id]], dtype=np.int64)
+        self._cache[query] = value_ids
+        return value_ids
+
+    def query(self, query: str) -> np.ndarray:
+        """
+        Return the sorted positions of the rows which contain the query.
+        """
+        value_ids = self.matching_values(query)
+        rows = [self.row_order[self.row_offsets[value_id]:self.row_offsets[value_id + 1]] for value_id in value_ids]
+        return np.sort(np.concatenate(rows)) if rows else np.zeros(0, dtype=np.int64)
+
+    def contains(self, query: str) -> np.ndarray:
+        """
+        Return a boolean mask of the rows which contain the query.
+        """
+        return np.isin(self.codes, self.matching_values(query))